@@ -0,0 +1,118 @@
+"""Throughput and latency of the acquisition paths of Keithley6487Wrapper against the simulated instrument
+
+Run with: python benchmarks/bench_acquisition.py [--latency 1e-3] [--nplc 0.01]
+"""
+import argparse
+import time
+
+import numpy as np
+
+from pymodaq_plugins_keithley.hardware.KeithleyWrapper import Keithley6487Wrapper, AdaptiveNPLC
+from pymodaq_plugins_keithley.hardware.simulator import SimulatedResourceManager, SIMULATED_RESOURCE
+
+
+def make_controller(latency: float, nplc: float) -> Keithley6487Wrapper:
+    controller = Keithley6487Wrapper(SIMULATED_RESOURCE, timeout=60000,
+                                     visa_rm=SimulatedResourceManager(latency=latency))
+    controller.setup()
+    controller.config_zerocheck(False)
+    controller.set_nplc(nplc)
+    controller.set_source_voltage(1.0)
+    controller.operate_source(True)
+    return controller
+
+
+def configure(controller: Keithley6487Wrapper, batched: bool):
+    """Full re-initialization with a preset of settings, the shadow state being cleared so that all are written"""
+    controller.configured = False
+    with controller.batch(opc=True) if batched else controller.lock:
+        controller.setup()
+        controller.set_range('2uA')
+        controller.set_nplc(1.0)
+        controller.config_zerocheck(False)
+        controller.set_source_range(10)
+        controller.set_source_voltage(1.0)
+        controller.operate_source(True)
+
+
+def scan(controller: Keithley6487Wrapper, volts: np.ndarray, nplc: float = 1.0,
+         scheduler: AdaptiveNPLC = None) -> float:
+    """Duration in s of a point by point I-V scan, at a fixed nplc or at the one chosen by scheduler"""
+    start = time.perf_counter()
+    for volt in volts:
+        if scheduler is not None:
+            nplc = scheduler.nplc_for(volt)
+        controller.set_nplc(nplc)
+        current = controller.set_and_measure(volt)[0][0]
+        if scheduler is not None:
+            scheduler.update(current, nplc, volt)
+    return time.perf_counter() - start
+
+
+def bench_adaptive_nplc(latency: float, max_nplc: float = 1.0):
+    """I-V scan of a 1 GOhm resistor, fixed NPLC against adaptive NPLC (first scan, then with the per setpoint cache)"""
+    controller = Keithley6487Wrapper(SIMULATED_RESOURCE, timeout=60000,
+                                     visa_rm=SimulatedResourceManager(latency=latency, resistance=1e9, noise=1e-12))
+    controller.setup()
+    controller.config_zerocheck(False)
+    controller.set_range('2nA')
+    controller.operate_source(True)
+    volts = np.linspace(-1, 1, 21)
+    scheduler = AdaptiveNPLC(target_snr=100, min_nplc=0.01, max_nplc=max_nplc)
+
+    print(f"\n{f'I-V scan ({len(volts)} points)':<26} {'total (s)':>12}")
+    print(f"{f'fixed NPLC {max_nplc}':<26} {scan(controller, volts, nplc=max_nplc):>12.3f}")
+    print(f"{'adaptive NPLC (1st scan)':<26} {scan(controller, volts, scheduler=scheduler):>12.3f}")
+    print(f"{'adaptive NPLC (2nd scan)':<26} {scan(controller, volts, scheduler=scheduler):>12.3f}")
+    controller.close()
+
+
+def measure(function, ncalls: int, readings_per_call: int) -> tuple:
+    """Readings per second and per call latencies (s) of ncalls calls of function"""
+    latencies = np.zeros(ncalls)
+    for ind in range(ncalls):
+        start = time.perf_counter()
+        function()
+        latencies[ind] = time.perf_counter() - start
+    return ncalls * readings_per_call / np.sum(latencies), latencies
+
+
+def report(name: str, rate: float, latencies: np.ndarray):
+    print(f"{name:<26} {rate:>12.1f} {np.median(latencies) * 1e3:>12.2f} {np.percentile(latencies, 99) * 1e3:>12.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--latency', type=float, default=1e-3, help='simulated time per bus transaction in s')
+    parser.add_argument('--nplc', type=float, default=0.01, help='integration time in power line cycles')
+    parser.add_argument('--ncalls', type=int, default=50, help='number of calls per benchmark')
+    args = parser.parse_args()
+
+    controller = make_controller(args.latency, args.nplc)
+    print(f"latency {args.latency * 1e3} ms, NPLC {args.nplc}")
+    print(f"{'':<26} {'readings/s':>12} {'p50 (ms)':>12} {'p99 (ms)':>12}")
+
+    controller.set_average(1)
+    report('single READ?', *measure(controller.read_current_and_vsource, args.ncalls, 1))
+
+    naverage = 10
+    report(f'software average ({naverage})',
+           *measure(lambda: [controller.read_current_and_vsource() for _ in range(naverage)], args.ncalls, naverage))
+    report(f'filter average ({naverage})',
+           *measure(lambda: controller.read_average(naverage), args.ncalls, naverage))
+    controller.set_average(1)
+
+    for npoints in [100, 1000]:
+        report(f'buffered ({npoints})', *measure(lambda: controller.read_buffer(npoints), args.ncalls, npoints))
+
+    ncalls = max(1, args.ncalls // 10)
+    report('configuration', *measure(lambda: configure(controller, batched=False), ncalls, 1))
+    report('configuration (batched)', *measure(lambda: configure(controller, batched=True), ncalls, 1))
+
+    controller.close()
+
+    bench_adaptive_nplc(args.latency)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+"""Compare the struct based decoding of REAL,32 readings with the vectorized record array decoder
+
+Run with: python benchmarks/bench_decode.py
+"""
+import struct
+import timeit
+
+import numpy as np
+
+from pymodaq_plugins_keithley.hardware.KeithleyWrapper import decode_readings, READING_DTYPE
+
+
+def make_payload(npoints: int) -> bytes:
+    """Synthetic TRAC:DATA? response: #0 header, npoints readings and the read termination"""
+    readings = np.zeros(npoints, dtype=READING_DTYPE)
+    readings['current'] = np.linspace(-1e-6, 1e-6, npoints)
+    readings['unit'] = b'A'
+    readings['time'] = np.arange(npoints) * 1e-3
+    readings['vsource'] = np.linspace(-10, 10, npoints)
+    return b'#0' + readings.tobytes() + b'\n'
+
+
+def decode_struct(vals: bytes, npoints: int) -> list:
+    """Per reading path as done by read_current_and_vsource"""
+    ret = []
+    for ind in range(npoints):
+        start = 2 + ind * READING_DTYPE.itemsize
+        current = np.array(struct.unpack('>f', vals[start:start + 4]))
+        unit = struct.unpack('c', vals[start + 4:start + 5])
+        time = struct.unpack('>f', vals[start + 5:start + 9])
+        status = struct.unpack('>f', vals[start + 9:start + 13])
+        vsource = np.array(struct.unpack('>f', vals[start + 13:start + 17]))
+        ret.append([current, vsource, time, status, unit])
+    return ret
+
+
+def main():
+    print(f"{'readings':>10} {'struct (us)':>14} {'frombuffer (us)':>16} {'speedup':>9}")
+    for npoints in [1, 1_000, 100_000]:
+        vals = make_payload(npoints)
+        number = max(1, 100_000 // npoints)
+        t_struct = min(timeit.repeat(lambda: decode_struct(vals, npoints), number=number, repeat=3)) / number
+        t_numpy = min(timeit.repeat(lambda: decode_readings(vals, npoints), number=number, repeat=3)) / number
+        print(f"{npoints:>10} {t_struct * 1e6:>14.1f} {t_numpy * 1e6:>16.1f} {t_struct / t_numpy:>9.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -45,7 +45,8 @@ setup(
     packages=find_packages(where='./src'),
     package_dir={'': 'src'},
     include_package_data=True,
-    entry_points={'pymodaq.plugins': f'{SHORT_PLUGIN_NAME} = {PLUGIN_NAME}'},
+    entry_points={'pymodaq.plugins': f'{SHORT_PLUGIN_NAME} = {PLUGIN_NAME}',
+                  'console_scripts': [f'keithley6487-acquire = {PLUGIN_NAME}.cli:main']},
     install_requires=['toml', ]+config['plugin-install']['packages-required'],
     **setupOpts
 )
@@ -0,0 +1,250 @@
+"""Headless acquisition with a Keithley 6487, for scripted logging without the PyMoDAQ dashboard
+
+The instrument is configured from a TOML file (see DEFAULT_CONFIG for the keys and their defaults), then readings are
+acquired one by one (single), block by block in the trace buffer (buffered), or block by block by a producer thread
+(streaming), and written to a .npy, .bin (raw records, see TIMED_READING_DTYPE) or .h5 (needs h5py) file, with
+periodic throughput statistics on stderr. Only the wrapper is imported, not pymodaq nor Qt.
+
+Example configuration::
+
+    [instrument]
+    visa = "GPIB0::22::INSTR"
+
+    [config]
+    range = "2uA"
+    nplc = 0.01
+    zerocheck = false
+
+    [acquisition]
+    mode = "streaming"
+    npoints = 1000
+    duration = 60.0
+
+    [output]
+    path = "run.h5"
+
+Run with: keithley6487-acquire config.toml [--mode buffered] [--duration 10] [--output run.npy]
+"""
+import argparse
+import struct
+import sys
+import time
+
+import numpy as np
+import toml
+
+from pymodaq_plugins_keithley.hardware.KeithleyWrapper import Keithley6487Wrapper, Keithley6487Streamer, \
+    acquire_controller, release_controller, TIMED_READING_DTYPE, BUFFER_MAX_POINTS, AVERAGE_MAX_COUNT
+from pymodaq_plugins_keithley.hardware.ring_buffer import RingBuffer
+
+MODES = ['single', 'buffered', 'streaming']
+NPY_HEADER_SIZE = 256  # Fixed, so that the header can be rewritten in place with the final number of readings
+
+DEFAULT_CONFIG = {
+    'instrument': {'visa': 'GPIB0::22::INSTR', 'timeout': 10000},
+    'config': {'range': '20mA', 'nplc': 5.0, 'zerocheck': True, 'average': 1},
+    'source': {'range': 10, 'voltage': 0.0, 'operate': False},
+    'acquisition': {'mode': 'buffered', 'npoints': 1000, 'duration': 0.0, 'stats_interval': 1.0},
+    'output': {'path': 'keithley_6487.npy', 'compression': 'gzip', 'flush_interval': 5.0},
+}
+
+
+def load_config(path: str) -> dict:
+    """DEFAULT_CONFIG updated with the content of the TOML file path"""
+    config = {section: dict(values) for section, values in DEFAULT_CONFIG.items()}
+    for section, values in toml.load(path).items():
+        if section not in config:
+            raise ValueError(f"Unknown section [{section}] in {path}, should be one of {list(config)}")
+        config[section].update(values)
+    if config['acquisition']['mode'] not in MODES:
+        raise ValueError(f"mode {config['acquisition']['mode']} not in {MODES}")
+    return config
+
+
+class NpyWriter:
+    """Append readings to a .npy file holding a 1D structured array, its header being updated on close"""
+
+    def __init__(self, path: str, dtype=TIMED_READING_DTYPE):
+        self.dtype = np.dtype(dtype)
+        self.count = 0
+        self.file = open(path, 'wb')
+        self.file.write(self._header())
+
+    def _header(self) -> bytes:
+        header = "{'descr': %r, 'fortran_order': False, 'shape': (%d,), }" % (
+            np.lib.format.dtype_to_descr(self.dtype), self.count)
+        header = header.ljust(NPY_HEADER_SIZE - 11) + '\n'
+        return np.lib.format.MAGIC_PREFIX + b'\x01\x00' + struct.pack('<H', len(header)) + header.encode('latin1')
+
+    def append(self, readings: np.ndarray):
+        self.file.write(np.asarray(readings, dtype=self.dtype).tobytes())
+        self.count += len(readings)
+
+    def close(self):
+        self.file.seek(0)
+        self.file.write(self._header())
+        self.file.close()
+
+
+class RawWriter:
+    """Append readings to a binary file as raw records of TIMED_READING_DTYPE (the REAL,32 ones with a float64 time)"""
+
+    def __init__(self, path: str):
+        self.file = open(path, 'wb')
+
+    def append(self, readings: np.ndarray):
+        self.file.write(np.asarray(readings, dtype=TIMED_READING_DTYPE).tobytes())
+
+    def close(self):
+        self.file.close()
+
+
+def open_writer(output: dict):
+    """Writer for the output file, chosen from its extension"""
+    path = output['path']
+    if path.endswith('.npy'):
+        return NpyWriter(path)
+    if path.endswith('.bin'):
+        return RawWriter(path)
+    if path.endswith(('.h5', '.hdf5')):
+        from pymodaq_plugins_keithley.hardware.h5_writer import ChunkedH5Writer  # h5py is only imported if needed
+        return ChunkedH5Writer(path, compression=output['compression'], flush_interval=output['flush_interval'])
+    raise ValueError(f"Unknown output format for {path}, should be .npy, .bin or .h5")
+
+
+def configure(controller: Keithley6487Wrapper, config: dict):
+    """Apply the [config] and [source] settings in a single bus transaction"""
+    with controller.batch(opc=True):
+        controller.setup()
+        controller.set_range(config['config']['range'])
+        controller.set_nplc(config['config']['nplc'])
+        controller.config_zerocheck(config['config']['zerocheck'])
+        controller.set_average(min(config['config']['average'], AVERAGE_MAX_COUNT))
+        if config['config']['average'] > AVERAGE_MAX_COUNT:
+            print(f"average {config['config']['average']} above the instrument filter capacity, "
+                  f"{AVERAGE_MAX_COUNT} conversions averaged per reading", file=sys.stderr, flush=True)
+        controller.set_source_range(config['source']['range'])
+        controller.set_source_voltage(config['source']['voltage'])
+        controller.operate_source(config['source']['operate'])
+
+
+class ThroughputStats:
+    """Periodic report of the number of acquired readings and of the acquisition rate"""
+
+    def __init__(self, interval: float = 1.0, stream=sys.stderr):
+        self.interval = interval
+        self.stream = stream
+        self.start = time.perf_counter()
+        self.last_time = self.start
+        self.last_count = 0
+
+    def update(self, count: int):
+        """Report if the interval has elapsed, count being the total number of readings"""
+        now = time.perf_counter()
+        if now - self.last_time >= self.interval:
+            self.report(count, now)
+
+    def report(self, count: int, now: float = None):
+        now = time.perf_counter() if now is None else now
+        rate = (count - self.last_count) / max(now - self.last_time, 1e-9)
+        mean_rate = count / max(now - self.start, 1e-9)
+        print(f"{now - self.start:10.1f} s {count:>12d} readings {rate:>12.1f} readings/s (mean {mean_rate:.1f})",
+              file=self.stream, flush=True)
+        self.last_time = now
+        self.last_count = count
+
+    def summary(self, count: int):
+        elapsed = time.perf_counter() - self.start
+        print(f"{count} readings in {elapsed:.1f} s ({count / max(elapsed, 1e-9):.1f} readings/s)",
+              file=self.stream, flush=True)
+
+
+def acquire(controller: Keithley6487Wrapper, writer, mode: str = 'buffered', npoints: int = 1000,
+            duration: float = 0.0, stats: ThroughputStats = None) -> int:
+    """Acquire readings into writer for duration seconds (until interrupted if 0)
+
+    Returns
+    -------
+    int: the number of readings acquired
+    """
+    if not 1 <= npoints <= BUFFER_MAX_POINTS:
+        raise ValueError(f"npoints {npoints} not in [1, {BUFFER_MAX_POINTS}]")
+    stats = ThroughputStats() if stats is None else stats
+    end = time.perf_counter() + duration if duration > 0 else np.inf
+    count = 0
+
+    try:
+        if mode == 'streaming':
+            # The producer thread writes each block, the ring buffer only gives the count to the main thread
+            ring = RingBuffer(npoints, TIMED_READING_DTYPE)
+            streamer = Keithley6487Streamer(controller, ring, npoints=npoints, writer=writer)
+            streamer.start()
+            try:
+                while time.perf_counter() < end and streamer.is_alive():
+                    time.sleep(min(stats.interval, 0.1))
+                    count = ring.count
+                    stats.update(count)
+            finally:
+                streamer.stop()
+                count = ring.count
+            if streamer.error is not None:
+                raise streamer.error
+
+        elif mode == 'buffered':
+            while time.perf_counter() < end:
+                writer.append(controller.read_buffer(npoints))
+                count += npoints
+                stats.update(count)
+
+        else:
+            block = np.zeros(npoints, dtype=TIMED_READING_DTYPE)
+            try:
+                while time.perf_counter() < end:
+                    current, vsource = controller.read_current_and_vsource()
+                    block[count % npoints] = (current[0], controller.unit, controller.time, controller.status,
+                                              vsource[0])
+                    count += 1
+                    if count % npoints == 0:
+                        writer.append(block)
+                    stats.update(count)
+            finally:
+                writer.append(block[:count % npoints])
+    except KeyboardInterrupt:
+        controller.abort()
+
+    stats.summary(count)
+    return count
+
+
+def main(argv: list = None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('config', help='TOML configuration file')
+    parser.add_argument('--visa', help='VISA resource, overrides [instrument] visa')
+    parser.add_argument('--mode', choices=MODES, help='overrides [acquisition] mode')
+    parser.add_argument('--duration', type=float, help='acquisition time in s (0: until Ctrl+C), overrides '
+                                                       '[acquisition] duration')
+    parser.add_argument('--output', help='.npy, .bin or .h5 file, overrides [output] path')
+    args = parser.parse_args(argv)
+
+    config = load_config(args.config)
+    for section, key, value in [('instrument', 'visa', args.visa), ('acquisition', 'mode', args.mode),
+                                ('acquisition', 'duration', args.duration), ('output', 'path', args.output)]:
+        if value is not None:
+            config[section][key] = value
+
+    controller = acquire_controller(config['instrument']['visa'], timeout=config['instrument']['timeout'])
+    writer = open_writer(config['output'])
+    try:
+        configure(controller, config)
+        print(f"{controller.get_device_infos()}: {config['acquisition']['mode']} acquisition to "
+              f"{config['output']['path']}", file=sys.stderr, flush=True)
+        acquire(controller, writer, mode=config['acquisition']['mode'], npoints=config['acquisition']['npoints'],
+                duration=config['acquisition']['duration'],
+                stats=ThroughputStats(config['acquisition']['stats_interval']))
+    finally:
+        writer.close()
+        release_controller(controller)
+
+
+if __name__ == '__main__':
+    main()
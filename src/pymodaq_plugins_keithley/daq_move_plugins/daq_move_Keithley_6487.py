@@ -1,11 +1,11 @@
 import numpy as np
 
-from pyvisa import ResourceManager
-
 from pymodaq.control_modules.move_utility_classes import DAQ_Move_base, comon_parameters_fun, main  # common set of parameters for all actuators
 from pymodaq.utils.daq_utils import ThreadCommand # object used to send info back to the main thread
 from pymodaq.utils.parameter import Parameter
-from pymodaq_plugins_keithley.hardware.KeithleyWrapper import Keithley6487Wrapper
+from pymodaq_plugins_keithley.hardware.KeithleyWrapper import Keithley6487Wrapper, release_controller
+from pymodaq_plugins_keithley.hardware.plugin_settings import DEFAULT_VISA, visa_params, config_params, \
+    update_visa_list, ini_controller, apply_config, configure, CONFIG_SETTERS
 
 class DAQ_Move_Keithley_6487(DAQ_Move_base):
     """Plugin for the Keithley 6487 voltage source.
@@ -23,22 +23,22 @@ class DAQ_Move_Keithley_6487(DAQ_Move_base):
     is_multiaxes = False
     axes_names = ['Vsource']
 
-    VISA_rm = ResourceManager()
-    com_ports = list(VISA_rm.list_resources())
-
     params = [{'title': 'Controller Status:', 'name': 'controller_status', 'type': 'list', 'value': 'Master', 'limits': ['Master', 'Slave']},
-              {'title': 'VISA:', 'name': 'visa', 'type': 'list', 'limits': com_ports},
-              {'title': 'Id:', 'name': 'id', 'type': 'text', 'value': ""},
-              {'title': 'Source Range:', 'name': 'source_range', 'type': 'list', 'value': 10, 'limits': [10, 50, 500]},
-              {'title': 'Operate Vsource', 'name': 'source_operate', 'type': 'bool', 'value': False, 'default': False},
+              ] + visa_params() + config_params('source_range', 'source_operate') + [
+              {'title': 'Settling time (s):', 'name': 'settling_time', 'type': 'float', 'value': 0.0, 'default': 0.0, 'min': 0.0},
+              {'title': 'Tolerance (V):', 'name': 'tolerance', 'type': 'float', 'value': 0.0, 'default': 0.0, 'min': 0.0,
+               'tip': 'Repeat the readback until the measured Vsource is within tolerance of the target, 0 to disable'},
               ] + comon_parameters_fun(is_multiaxes, axes_names)
 
     def ini_attributes(self):
         #  TODO declare the type of the wrapper (and assign it to self.controller) you're going to use for easy
         #  autocompletion
         self.controller: Keithley6487Wrapper = None
+        self.settled: bool = True  # False if the last move did not reach its tolerance
 
-        self.settings.child('visa').setValue("GPIB0::22::INSTR")
+        # VISA buses are only enumerated now, not when the plugin module is imported
+        update_visa_list(self.settings.child('visa'))
+        self.settings.child('visa').setValue(DEFAULT_VISA)
 
     def get_actuator_value(self):
         """Get the current value from the hardware with scaling conversion.
@@ -47,22 +47,23 @@ class DAQ_Move_Keithley_6487(DAQ_Move_base):
         -------
         float: The position obtained after scaling conversion.
         """
-        # if self.settings.child('controller_status').value() == "Slave":
-        #     if not self.controller.measurement_obsolete:
-        #         pos = self.controller.current_V
-        #     else:
-        #         pos = self.controller.read_current_and_vsource()[1]
-        #     self.controller.measurement_obsolete = True
-        # else:
-        #     pos = self.controller.read_current_and_vsource()[1]
-        #
-        # pos = self.get_position_with_scaling(pos)
-        # print(pos)
-        return self.target_position
+        # The measured Vsource is 0 with the source off (it is off after *RST until operate_source(True)) and does
+        # not reach the target if the move did not settle: report the target so that the move can be done
+        if not self.controller.get_setting('source_operate') or not self.settled:
+            return self.target_position
+
+        # The last reading (of this plugin or of a viewer sharing the controller) is valid until the source changes
+        if self.controller.measurement_obsolete:
+            self.controller.read_current_and_vsource()
+        pos = float(self.controller.current_V[0])
+
+        pos = self.get_position_with_scaling(pos)
+        return pos
 
     def close(self):
         """Terminate the communication protocol"""
-        self.controller.close()
+        if self.settings.child('controller_status').value() == "Master":
+            release_controller(self.controller)
 
     def update_bounds(self,newbound):
         self.settings.child('bounds', 'max_bound').setValue(newbound)
@@ -76,11 +77,12 @@ class DAQ_Move_Keithley_6487(DAQ_Move_base):
         param: Parameter
             A given parameter (within detector_settings) whose value has been changed by the user
         """
-        if param.name() == 'source_range':
-            self.controller.set_source_range(range_s=param.value())
-            self.update_bounds(float(param.value()))
-        elif param.name() == 'source_operate':
-            self.controller.operate_source(oper=param.value())
+        if param.name() == 'refresh_visa':
+            update_visa_list(self.settings.child('visa'), refresh=True)
+        elif param.name() in CONFIG_SETTERS:
+            apply_config([self.controller], param.name(), param.value())
+            if param.name() == 'source_range':
+                self.update_bounds(float(param.value()))
 
     def ini_stage(self, controller=None):
         """Actuator communication initialization
@@ -97,24 +99,15 @@ class DAQ_Move_Keithley_6487(DAQ_Move_base):
             False if initialization failed otherwise True
         """
 
-        if self.settings.child('controller_status').value() == "Slave":
-            keithley_6487 = None
-        else:
-            keithley_6487 = Keithley6487Wrapper(visa_resource=self.settings.child('visa').value(),
-                                                timeout=1000)
-
         self.ini_stage_init(old_controller=controller,
-                            new_controller=keithley_6487)
+                            new_controller=ini_controller(self.settings))
 
         dvc = self.controller.get_device_infos()
         self.settings.child('id').setValue(dvc)
 
-        if self.settings.child('controller_status').value != "Slave":
-            # Reset comm state
-            self.controller.reset()
-            # Update things in the interface
-            self.controller.config_mode('CURR')
-            self.controller.config_reading()
+        # Reset comm state and configure the reading format (only done by the first plugin using this controller),
+        # then apply the source range and state shown in the settings
+        configure(self.controller, self.settings)
 
         info = "Whatever info you want to log"
         initialized = True
@@ -132,8 +125,7 @@ class DAQ_Move_Keithley_6487(DAQ_Move_base):
         self.target_position = value
         value = self.set_position_with_scaling(value)  # apply scaling if the user specified one
 
-        self.controller.set_source_voltage(volts=value)  # when writing your own plugin replace this line
-        self.emit_status(ThreadCommand('Update_Status', [f'Source Voltage set to {value}']))
+        self.set_and_measure(volts=value)
 
 
     def move_rel(self, value):
@@ -147,14 +139,25 @@ class DAQ_Move_Keithley_6487(DAQ_Move_base):
         self.target_position = value + self.current_position
         value = self.set_position_relative_with_scaling(value)
 
-        self.controller.set_source_voltage(volts=self.target_position)  # when writing your own plugin replace this line
-        self.emit_status(ThreadCommand('Update_Status', [f'Source Voltage set to {self.target_position}']))
+        self.set_and_measure(volts=self.target_position)
 
     def move_home(self):
         """Call the reference method of the controller"""
-        self.controller.set_source_voltage(volts=0.0)  # when writing your own plugin replace this line
-        self.emit_status(ThreadCommand('Update_Status', [f'Source Voltage set to 0.0']))
-
+        self.target_position = self.get_position_with_scaling(0.0)
+        self.set_and_measure(volts=0.0)
+
+
+    def set_and_measure(self, volts: float):
+        """Set the source voltage and read back the settled Vsource, reported by the next get_actuator_value"""
+        tolerance = self.settings.child('tolerance').value()
+        vsource = self.controller.set_and_measure(volts, settling_time=self.settings.child('settling_time').value(),
+                                                  tolerance=tolerance if tolerance > 0 else None)[1]
+        self.settled = tolerance == 0 or abs(vsource[0] - volts) <= tolerance
+        if self.settled:
+            self.emit_status(ThreadCommand('Update_Status', [f'Source Voltage set to {volts}, measured {vsource[0]}']))
+        else:
+            self.emit_status(ThreadCommand('Update_Status', [f'Source Voltage set to {volts} did not settle within '
+                                                             f'{tolerance} V, measured {vsource[0]}', 'log']))
 
     def stop_motion(self):
       """Stop the actuator and emits move_done signal"""
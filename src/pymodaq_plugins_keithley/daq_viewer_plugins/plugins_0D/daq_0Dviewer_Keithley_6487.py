@@ -1,11 +1,18 @@
+import time
+
 import numpy as np
-from pyvisa import ResourceManager
 
 from pymodaq.daq_utils.daq_utils import ThreadCommand
-from pymodaq.utils.data import DataFromPlugins
+from pymodaq.utils.data import DataFromPlugins, Axis
 from pymodaq.control_modules.viewer_utility_classes import DAQ_Viewer_base, comon_parameters, main
 from pymodaq.daq_utils.parameter import Parameter
-from pymodaq_plugins_keithley.hardware.KeithleyWrapper import Keithley6487Wrapper
+from pymodaq_plugins_keithley.hardware.KeithleyWrapper import Keithley6487Wrapper, Keithley6487Streamer, \
+    release_controller, AutoRanger, AdaptiveNPLC, BUFFER_MAX_POINTS, TIMED_READING_DTYPE, CURRENT_RANGES
+from pymodaq_plugins_keithley.hardware.plugin_settings import DEFAULT_VISA, visa_params, config_params, \
+    update_visa_list, ini_controller, apply_config, set_filter_average, configure, \
+    CONFIG_SETTERS
+from pymodaq_plugins_keithley.hardware.ring_buffer import RingBuffer
+from pymodaq_plugins_keithley.hardware.h5_writer import ChunkedH5Writer, COMPRESSIONS
 
 
 class DAQ_0DViewer_Keithley_6487(DAQ_Viewer_base):
@@ -13,39 +20,71 @@ class DAQ_0DViewer_Keithley_6487(DAQ_Viewer_base):
             ==================== ========================
             **Attributes**        **Type**
             *data_grabed_signal*  instance of Signal
-            *VISA_rm*             ResourceManager
-            *com_ports*
             *params*              dictionnary list
             *keithley*
             *settings*
             ==================== ========================
         """
 
-    VISA_rm = ResourceManager()
-    com_ports = list(VISA_rm.list_resources())
-
+    hardware_averaging = True
 
-
-    params = comon_parameters + [
-        {'title': 'VISA:', 'name': 'visa', 'type': 'list', 'limits': com_ports},
-        {'title': 'Id:', 'name': 'id', 'type': 'text', 'value': ""},
-        {'title': 'Timeout (ms):', 'name': 'timeout', 'type': 'int', 'value': 10000, 'default': 10000, 'min': 2000},
-        {'title': 'Configuration:', 'name': 'config', 'type': 'group', 'children':
+    params = comon_parameters + visa_params() + [
+        {'title': 'Configuration:', 'name': 'config', 'type': 'group', 'children': config_params()},
+        {'title': 'Software autorange:', 'name': 'autorange', 'type': 'group', 'children':
+            [
+            {'title': 'Enabled', 'name': 'enabled', 'type': 'bool', 'value': False, 'default': False},
+            {'title': 'Upper threshold:', 'name': 'upper', 'type': 'float', 'value': 0.9, 'default': 0.9, 'min': 0.1, 'max': 1.0},
+            {'title': 'Lower threshold:', 'name': 'lower', 'type': 'float', 'value': 0.05, 'default': 0.05, 'min': 0.001, 'max': 0.099,
+             'tip': 'Should be below upper threshold / 10'},
+            ]
+        },
+        {'title': 'Adaptive NPLC:', 'name': 'adaptive_nplc', 'type': 'group', 'children':
+            [
+            {'title': 'Enabled', 'name': 'enabled', 'type': 'bool', 'value': False, 'default': False},
+            {'title': 'Target SNR:', 'name': 'target_snr', 'type': 'float', 'value': 100.0, 'default': 100.0, 'min': 1.0},
+            {'title': 'Min NPLC:', 'name': 'min_nplc', 'type': 'float', 'value': 0.01, 'default': 0.01, 'min': 0.01, 'max': 50},
+            {'title': 'Max NPLC:', 'name': 'max_nplc', 'type': 'float', 'value': 10.0, 'default': 10.0, 'min': 0.01, 'max': 50},
+            {'title': 'Noise at 1 NPLC (A):', 'name': 'noise', 'type': 'float', 'value': 1e-12, 'default': 1e-12, 'min': 0.0},
+            ]
+        },
+        {'title': 'Acquisition:', 'name': 'acquisition', 'type': 'group', 'children':
             [
-            {'title': 'Range:', 'name': 'range', 'type': 'list', 'value': '20mA', 'default': '20mA', 'limits': ["20mA", "2mA", "200uA", "20uA", "2uA", "200nA", "20nA", "2nA"]},
-            {'title': 'NPLC:', 'name': 'nplc', 'type': 'float', 'value': 5.0, 'default': 5.0, 'min': 0.01, 'max': 50},
-            {'title': 'Zerocheck', 'name': 'zerocheck', 'type': 'bool', 'value': True, 'default': True},
-            {'title': 'Source Range:', 'name': 'source_range', 'type': 'list', 'value': 10, 'limits': [10, 50, 500]},
-            {'title': 'Source Voltage (V):', 'name': 'source_voltage', 'type': 'float', 'value': 0.0, 'default': 5.0, 'min': 0.01, 'max': 50},
-            {'title': 'Operate Vsource', 'name': 'source_operate', 'type': 'bool', 'value': False, 'default': False},
+            {'title': 'Mode:', 'name': 'mode', 'type': 'list', 'value': 'Single', 'default': 'Single', 'limits': ['Single', 'Buffered', 'Streaming']},
+            {'title': 'Buffered points:', 'name': 'npoints', 'type': 'int', 'value': 100, 'default': 100, 'min': 1, 'max': BUFFER_MAX_POINTS},
+            {'title': 'Asynchronous grab', 'name': 'asynchronous', 'type': 'bool', 'value': False, 'default': False},
+            {'title': 'Poll interval (ms):', 'name': 'poll_interval', 'type': 'int', 'value': 50, 'default': 50, 'min': 1},
+            {'title': 'Ring buffer size:', 'name': 'ring_size', 'type': 'int', 'value': 1000000, 'default': 1000000, 'min': BUFFER_MAX_POINTS},
+            {'title': 'Display rate (Hz):', 'name': 'display_rate', 'type': 'float', 'value': 10.0, 'default': 10.0, 'min': 0.01, 'max': 100},
+            {'title': 'Emit timestamps', 'name': 'timestamps', 'type': 'bool', 'value': True, 'default': True,
+             'tip': 'Also emit the instrument timestamps mapped to host time and the status of the readings'},
+            {'title': 'Profile transactions', 'name': 'profiling', 'type': 'bool', 'value': False, 'default': False},
+            ]
+        },
+        {'title': 'Streaming to disk:', 'name': 'to_disk', 'type': 'group', 'children':
+            [
+            {'title': 'Enabled', 'name': 'enabled', 'type': 'bool', 'value': False, 'default': False},
+            {'title': 'HDF5 file:', 'name': 'path', 'type': 'browsepath', 'value': '', 'filetype': True},
+            {'title': 'Compression:', 'name': 'compression', 'type': 'list', 'value': 'gzip', 'limits': COMPRESSIONS},
+            {'title': 'Flush interval (s):', 'name': 'flush_interval', 'type': 'float', 'value': 5.0, 'default': 5.0, 'min': 0.1},
             ]
         },
     ]
 
     def ini_attributes(self):
         self.controller: Keithley6487Wrapper = None
-
-        self.settings.child('visa').setValue("GPIB0::22::INSTR")
+        self.streamer: Keithley6487Streamer = None
+        self.writer: ChunkedH5Writer = None
+        self.ring: RingBuffer = None
+        self.stream_index: int = 0
+        self.last_emission: float = 0.0
+        self.last_profiling_status: float = 0.0
+        self.autoranger = AutoRanger()
+        self.average_status: str = ''  # Last reported capping of Naverage, see set_filter_average
+        self.nplc_scheduler = AdaptiveNPLC()
+
+        # VISA buses are only enumerated now, not when the plugin module is imported
+        update_visa_list(self.settings.child('visa'))
+        self.settings.child('visa').setValue(DEFAULT_VISA)
 
     def commit_settings(self, param: Parameter):
         """Apply the consequences of a change of value in the detector settings
@@ -55,18 +94,39 @@ class DAQ_0DViewer_Keithley_6487(DAQ_Viewer_base):
         param: Parameter
             A given parameter (within detector_settings) whose value has been changed by the user
         """
-        if param.name() == "range":
-            self.controller.set_range(range=param.value())  # when writing your own plugin replace this line
-        elif param.name() == 'nplc':
-            self.controller.set_nplc(nplc=param.value())
-        elif param.name() == 'source_range':
-            self.controller.set_source_range(range_s=param.value())
-        elif param.name() == 'source_voltage':
-            self.controller.set_source_voltage(volts=param.value())
-        elif param.name() == 'zerocheck':
-            self.controller.config_zerocheck(active=param.value())
-        elif param.name() == 'source_operate':
-            self.controller.operate_source(oper=param.value())
+        if param.name() == 'refresh_visa':
+            update_visa_list(self.settings.child('visa'), refresh=True)
+        elif param.name() == 'nplc' and self.settings.child('adaptive_nplc', 'enabled').value():
+            # The NPLC chosen by the user wins over the scheduler, which would override it at the next grab
+            self.controller.set_nplc(param.value())
+            self.emit_status(ThreadCommand('Update_Status', ['NPLC set by hand: Adaptive NPLC disabled', 'log']))
+            self.settings.child('adaptive_nplc', 'enabled').setValue(False)
+        elif param.name() in CONFIG_SETTERS:
+            apply_config([self.controller], param.name(), param.value())
+        elif param.name() in ['mode', 'npoints', 'ring_size'] or param.parent().name() == 'to_disk':
+            self.stop_stream()
+        elif param.name() in ['upper', 'lower']:
+            try:
+                self.autoranger = AutoRanger(upper=self.settings.child('autorange', 'upper').value(),
+                                             lower=self.settings.child('autorange', 'lower').value())
+            except ValueError as error:
+                # Keep the thresholds in use, and show them back
+                self.emit_status(ThreadCommand('Update_Status', [f'Autorange thresholds not changed: {error}', 'log']))
+                param.setValue(getattr(self.autoranger, param.name()))
+        elif param.parent().name() == 'adaptive_nplc' and param.name() == 'enabled':
+            if not param.value():  # Back to the configured NPLC instead of the last scheduled one
+                self.controller.set_nplc(self.settings.child('config', 'nplc').value())
+        elif param.parent().name() == 'adaptive_nplc':
+            self.nplc_scheduler = AdaptiveNPLC(
+                target_snr=self.settings.child('adaptive_nplc', 'target_snr').value(),
+                min_nplc=self.settings.child('adaptive_nplc', 'min_nplc').value(),
+                max_nplc=self.settings.child('adaptive_nplc', 'max_nplc').value(),
+                noise=self.settings.child('adaptive_nplc', 'noise').value())
+        elif param.name() == 'profiling':
+            if param.value():
+                self.controller.enable_profiling()
+            else:
+                self.controller.disable_profiling()
 
         ##
 
@@ -86,26 +146,17 @@ class DAQ_0DViewer_Keithley_6487(DAQ_Viewer_base):
             False if initialization failed otherwise True
         """
 
-        if self.settings.child('controller_status').value() == "Slave":
-            keithley_6487 = None
-        else:
-            keithley_6487 = Keithley6487Wrapper(visa_resource=self.settings.child('visa').value(),
-                                                timeout=self.settings.child('timeout').value(), )
-
         self.ini_detector_init(old_controller=controller,
-                               new_controller=keithley_6487)
+                               new_controller=ini_controller(self.settings))
 
 
         # Update things in the interface
         dvc = self.controller.get_device_infos()
         self.settings.child('id').setValue(dvc)
 
-        if self.settings.child('controller_status').value != "Slave":
-            # Reset comm state
-            self.controller.reset()
-            # Update things in the interface
-            self.controller.config_mode('CURR')
-            self.controller.config_reading()
+        # Reset comm state and configure the reading format (only done by the first plugin using this controller),
+        # then apply the configuration shown in the settings
+        configure(self.controller, self.settings.child('config'))
 
         # initialize viewers panel with the future type of data
         self.data_grabed_signal_temp.emit([DataFromPlugins(name='Keithley_6487',
@@ -120,7 +171,9 @@ class DAQ_0DViewer_Keithley_6487(DAQ_Viewer_base):
 
     def close(self):
         """Terminate the communication protocol"""
-        self.controller.close()
+        self.stop_stream()
+        if self.settings.child('controller_status').value() == "Master":
+            release_controller(self.controller)
 
     def grab_data(self, Naverage=1, **kwargs):
         """Start a grab from the detector
@@ -128,40 +181,215 @@ class DAQ_0DViewer_Keithley_6487(DAQ_Viewer_base):
         Parameters
         ----------
         Naverage: int
-            Number of hardware averaging (if hardware averaging is possible, self.hardware_averaging should be set to
-            True in class preamble and you should code this implementation)
+            Number of hardware averaging: done by the instrument digital filter (each buffered reading is then
+            itself averaged), or from the trace buffer above the filter capacity in Single mode. The other modes
+            are capped at the filter capacity, which is reported
         kwargs: dict
             others optionals arguments
         """
 
-        data = self.controller.read_current_and_vsource()
-        self.data_grabed_signal.emit([DataFromPlugins(name='Keithley_6487',
-                                                      data=data,
-                                                      dim='Data0D',
-                                                      labels=['I', 'Vso'],
-                                                      )])
-
-        #########################################################
-        #
-        # # asynchrone version (non-blocking function with callback)
-        # raise NotImplemented  # when writing your own plugin remove this line
-        # when writing your own plugin replace this line
-        # self.controller.your_method_to_start_a_grab_snap(self.callback)
-        # #########################################################
-
-    def callback(self):
-        """optional asynchrone method called when the detector has finished its acquisition of data"""
-        data_tot = self.controller.your_method_to_get_data_from_buffer()
-        self.data_grabed_signal.emit([DataFromPlugins(name='Mock1', data=data_tot,
-                                                      dim='Data0D', labels=['dat0', 'data1'])])
+        self.show_profiling()
+
+        if self.settings.child('acquisition', 'mode').value() == 'Streaming':
+            self.set_filter_average(Naverage)
+            self.grab_stream()
+            return
+
+        buffered = self.settings.child('acquisition', 'mode').value() == 'Buffered'
+
+        if self.settings.child('acquisition', 'asynchronous').value():
+            # asynchrone version (non-blocking function with callback)
+            self.set_filter_average(Naverage)
+            self.controller.start_acquisition(
+                self.emit_buffer if buffered else self.callback,
+                npoints=self.settings.child('acquisition', 'npoints').value() if buffered else None,
+                poll_interval=self.settings.child('acquisition', 'poll_interval').value() / 1000,
+                error_callback=self.acquisition_error)
+            return
+
+        if buffered:
+            self.set_filter_average(Naverage)
+            self.emit_buffer(self.controller.read_buffer(self.settings.child('acquisition', 'npoints').value()))
+            return
+
+        adaptive = self.settings.child('adaptive_nplc', 'enabled').value()
+        if adaptive:
+            setpoint = self.controller.get_setting('source_voltage')
+            nplc = self.nplc_scheduler.nplc_for(setpoint)
+            self.controller.set_nplc(nplc)
+
+        if self.settings.child('autorange', 'enabled').value():
+            data = self.read_autorange(Naverage)
+        else:
+            data = self.controller.read_average(Naverage)
+
+        if adaptive:
+            self.nplc_scheduler.update(data[0][0], nplc, setpoint, count=Naverage)
+        self.callback(data)
+
+    def set_filter_average(self, Naverage: int):
+        """Average Naverage conversions per reading with the instrument filter, reporting once that it is capped"""
+        message = set_filter_average(self.controller, Naverage)
+        if message and message != self.average_status:
+            self.emit_status(ThreadCommand('Update_Status', [message, 'log']))
+        self.average_status = message
+
+    def read_autorange(self, Naverage: int) -> list:
+        """Averaged reading, the range being stepped until the reading is within the autorange thresholds
+
+        The measurement starts on the last good range found for the current source voltage, so that repeated scans
+        do not pay the range settling again. The returned data is always measured on the final range, which is only
+        remembered if its reading is within the thresholds.
+        """
+        setpoint = self.controller.get_setting('source_voltage')
+        rangecurrent = self.autoranger.recall(setpoint)
+        if rangecurrent is None:
+            rangecurrent = self.controller.get_setting('range') or self.settings.child('config', 'range').value()
+        self.controller.set_range(rangecurrent)
+
+        data = self.controller.read_average(Naverage)
+        for _ in range(len(CURRENT_RANGES)):
+            new_range = self.autoranger.next_range(rangecurrent, data[0][0], self.controller.status)
+            if new_range is None:
+                self.autoranger.remember(setpoint, rangecurrent)
+                break
+            rangecurrent = new_range
+            self.controller.set_range(rangecurrent)
+            data = self.controller.read_average(Naverage)
+
+        self.settings.child('config', 'range').setValue(rangecurrent)
+        return data
+
+    def timing_data(self, readings: np.recarray) -> list:
+        """Host time (mapped from the instrument timestamps, see clock.ClockOffsetEstimator) and status of readings
+
+        Returns
+        -------
+        list of DataFromPlugins: empty if timestamps are not emitted
+        """
+        if not self.settings.child('acquisition', 'timestamps').value():
+            return []
+        return [DataFromPlugins(name='Keithley_6487_timing',
+                                data=[self.controller.clock.to_host(readings['time']),
+                                      np.asarray(readings['status'], dtype=float)],
+                                dim='Data1D',
+                                labels=['host time', 'status'],
+                                axes=[Axis('time', units='s', data=readings['time'], index=0)])]
+
+    def emit_buffer(self, readings: np.recarray):
+        """Burst acquisition: readings fetched in one transfer, emitted as their mean and as a trace"""
+        if len(readings) == 0:  # Aborted
+            return
+        self.data_grabed_signal.emit([
+            DataFromPlugins(name='Keithley_6487',
+                            data=[np.array([np.mean(readings['current'])]),
+                                  np.array([np.mean(readings['vsource'])])],
+                            dim='Data0D',
+                            labels=['I', 'Vso']),
+            DataFromPlugins(name='Keithley_6487_buffer',
+                            data=[readings['current'], readings['vsource']],
+                            dim='Data1D',
+                            labels=['I', 'Vso'],
+                            axes=[Axis('time', units='s', data=readings['time'], index=0)]),
+        ] + self.timing_data(readings))
+
+    def show_profiling(self):
+        """Display the transactions p50/p99 in the status bar, at most every second"""
+        if self.controller.profiler is None or time.perf_counter() - self.last_profiling_status < 1:
+            return
+        self.last_profiling_status = time.perf_counter()
+        self.emit_status(ThreadCommand('Update_Status', [self.controller.profiler.status()]))
+
+    def start_stream(self):
+        self.ring = RingBuffer(self.settings.child('acquisition', 'ring_size').value(), TIMED_READING_DTYPE)
+        self.stream_index = 0
+        if self.settings.child('to_disk', 'enabled').value():
+            self.writer = ChunkedH5Writer(self.settings.child('to_disk', 'path').value(),
+                                          compression=self.settings.child('to_disk', 'compression').value(),
+                                          flush_interval=self.settings.child('to_disk', 'flush_interval').value())
+        self.streamer = Keithley6487Streamer(self.controller, self.ring,
+                                             npoints=self.settings.child('acquisition', 'npoints').value(),
+                                             writer=self.writer)
+        self.streamer.start()
+
+    def stop_stream(self):
+        if self.streamer is not None:
+            self.streamer.stop()
+            self.streamer = None
+        if self.writer is not None:
+            if self.controller.clock.ready:  # so that the instrument timestamps can be mapped to host time offline
+                self.writer.datasets['time'].attrs.update(clock_offset=self.controller.clock.offset,
+                                                          clock_drift=self.controller.clock.drift,
+                                                          clock_t0=self.controller.clock.t0)
+            self.writer.close()
+            self.writer = None
+
+    def grab_stream(self):
+        """Emit the readings streamed since the last grab, paced to the display rate
+
+        The full rate block is emitted as a trace (for saving) together with its mean/min/max for live display. The
+        ring buffer bounds the memory use: if grabs lag behind by more than its size, the oldest readings are lost.
+        When streaming to disk, the streamer thread writes every reading to the HDF5 file and only the mean/min/max
+        preview is emitted.
+        """
+        if self.streamer is None:
+            self.start_stream()
+
+        period = 1 / self.settings.child('acquisition', 'display_rate').value()
+        time.sleep(max(0.0, self.last_emission + period - time.perf_counter()))
+        readings, self.stream_index = self.ring.read_since(self.stream_index)
+        while len(readings) == 0 and self.streamer.is_alive():
+            time.sleep(period / 10)
+            readings, self.stream_index = self.ring.read_since(self.stream_index)
+        self.last_emission = time.perf_counter()
+
+        if self.streamer.error is not None:
+            self.emit_status(ThreadCommand('Update_Status', [f'Streaming stopped: {self.streamer.error}', 'log']))
+            self.stop_stream()
+        if len(readings) == 0:
+            return
+
+        data = [DataFromPlugins(name='Keithley_6487',
+                                data=[np.array([np.mean(readings['current'])]),
+                                      np.array([np.min(readings['current'])]),
+                                      np.array([np.max(readings['current'])]),
+                                      np.array([np.mean(readings['vsource'])])],
+                                dim='Data0D',
+                                labels=['I', 'I min', 'I max', 'Vso'])]
+        if self.writer is None:
+            data.append(DataFromPlugins(name='Keithley_6487_stream',
+                                        data=[readings['current'], readings['vsource']],
+                                        dim='Data1D',
+                                        labels=['I', 'Vso'],
+                                        axes=[Axis('time', units='s', data=readings['time'], index=0)]))
+            data.extend(self.timing_data(readings))
+        self.data_grabed_signal.emit(data)
+
+    def callback(self, data: list):
+        """Emit a single [I, Vsource] reading, also called from the controller waiter thread in asynchronous mode"""
+        data = [DataFromPlugins(name='Keithley_6487',
+                                data=data,
+                                dim='Data0D',
+                                labels=['I', 'Vso'],
+                                )]
+        if self.settings.child('acquisition', 'timestamps').value():
+            data.append(DataFromPlugins(name='Keithley_6487_timing',
+                                        data=[np.array([self.controller.time]),
+                                              self.controller.clock.to_host([self.controller.time]),
+                                              np.array([self.controller.status])],
+                                        dim='Data0D',
+                                        labels=['instrument time', 'host time', 'status']))
+        self.data_grabed_signal.emit(data)
+
+    def acquisition_error(self, error: Exception):
+        """Report an exception raised in the controller waiter thread (asynchronous grab)"""
+        self.emit_status(ThreadCommand('Update_Status', [f'Asynchronous acquisition failed: {error}', 'log']))
 
     def stop(self):
         """Stop the current grab hardware wise if necessary"""
-        # raise NotImplemented  # when writing your own plugin remove this line
-        # self.controller.your_method_to_stop_acquisition()  # when writing your own plugin replace this line
-
-        self.emit_status(ThreadCommand('Update_Status', ['Some info you want to log']))
-        ##############################
+        self.stop_stream()  # aborts the block being streamed
+        self.controller.abort()
+        self.emit_status(ThreadCommand('Update_Status', ['Acquisition aborted']))
         return ''
 
 
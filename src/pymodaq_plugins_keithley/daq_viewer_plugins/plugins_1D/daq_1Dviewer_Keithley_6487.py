@@ -0,0 +1,119 @@
+import numpy as np
+
+from pymodaq.utils.daq_utils import ThreadCommand
+from pymodaq.utils.data import DataFromPlugins, Axis
+from pymodaq.control_modules.viewer_utility_classes import DAQ_Viewer_base, comon_parameters, main
+from pymodaq.utils.parameter import Parameter
+from pymodaq_plugins_keithley.hardware.KeithleyWrapper import Keithley6487Wrapper, release_controller, \
+    BUFFER_MAX_POINTS
+from pymodaq_plugins_keithley.hardware.plugin_settings import DEFAULT_VISA, visa_params, config_params, \
+    update_visa_list, ini_controller, apply_config, set_filter_average, configure, \
+    CONFIG_SETTERS
+
+
+class DAQ_1DViewer_Keithley_6487(DAQ_Viewer_base):
+    """Time trace of the Keithley 6487 current
+
+    Each grab acquires N readings in the instrument buffer, fetches them in one transfer and returns them as a single
+    Data1D with the instrument timestamps as axis.
+    """
+
+    hardware_averaging = True
+
+    params = comon_parameters + visa_params() + [
+        {'title': 'Configuration:', 'name': 'config', 'type': 'group', 'children': config_params()},
+        {'title': 'Readings per grab:', 'name': 'npoints', 'type': 'int', 'value': 100, 'default': 100, 'min': 1, 'max': BUFFER_MAX_POINTS},
+    ]
+
+    def ini_attributes(self):
+        self.controller: Keithley6487Wrapper = None
+        self.average_status: str = ''  # Last reported capping of Naverage
+
+        update_visa_list(self.settings.child('visa'))
+        self.settings.child('visa').setValue(DEFAULT_VISA)
+
+    def commit_settings(self, param: Parameter):
+        """Apply the consequences of a change of value in the detector settings
+
+        Parameters
+        ----------
+        param: Parameter
+            A given parameter (within detector_settings) whose value has been changed by the user
+        """
+        if param.name() == 'refresh_visa':
+            update_visa_list(self.settings.child('visa'), refresh=True)
+        elif param.name() in CONFIG_SETTERS:
+            apply_config([self.controller], param.name(), param.value())
+
+    def ini_detector(self, controller=None):
+        """Detector communication initialization
+
+        Parameters
+        ----------
+        controller: (object)
+            custom object of a PyMoDAQ plugin (Slave case). None if only one actuator/detector by controller
+            (Master case)
+
+        Returns
+        -------
+        info: str
+        initialized: bool
+            False if initialization failed otherwise True
+        """
+        self.ini_detector_init(old_controller=controller,
+                               new_controller=ini_controller(self.settings))
+
+        dvc = self.controller.get_device_infos()
+        self.settings.child('id').setValue(dvc)
+
+        configure(self.controller, self.settings.child('config'))
+
+        self.data_grabed_signal_temp.emit([DataFromPlugins(name='Keithley_6487',
+                                                           data=[np.zeros(self.settings.child('npoints').value()),
+                                                                 np.zeros(self.settings.child('npoints').value())],
+                                                           dim='Data1D',
+                                                           labels=['I', 'Vso'])])
+
+        info = f"Initialized - {self.settings.child('controller_status').value()} {dvc}"
+        initialized = True
+        return info, initialized
+
+    def close(self):
+        """Terminate the communication protocol"""
+        if self.settings.child('controller_status').value() == "Master":
+            release_controller(self.controller)
+
+    def grab_data(self, Naverage=1, **kwargs):
+        """Acquire the readings in the instrument buffer and emit them as a time trace
+
+        Parameters
+        ----------
+        Naverage: int
+            Number of hardware averaging, done by the instrument digital filter for each reading
+        kwargs: dict
+            others optionals arguments
+        """
+        message = set_filter_average(self.controller, Naverage)
+        if message and message != self.average_status:
+            self.emit_status(ThreadCommand('Update_Status', [message, 'log']))
+        self.average_status = message
+        readings = self.controller.read_buffer(self.settings.child('npoints').value())
+        if len(readings) == 0:  # Aborted
+            return
+        self.data_grabed_signal.emit([DataFromPlugins(name='Keithley_6487',
+                                                      data=[readings['current'], readings['vsource']],
+                                                      dim='Data1D',
+                                                      labels=['I', 'Vso'],
+                                                      axes=[Axis('time', units='s',
+                                                                 data=readings['time'] - readings['time'][0],
+                                                                 index=0)])])
+
+    def stop(self):
+        """Stop the current grab hardware wise if necessary"""
+        self.controller.abort()
+        self.emit_status(ThreadCommand('Update_Status', ['Acquisition aborted']))
+        return ''
+
+
+if __name__ == '__main__':
+    main(__file__)
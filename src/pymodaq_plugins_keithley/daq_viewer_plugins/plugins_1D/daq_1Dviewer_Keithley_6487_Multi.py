@@ -0,0 +1,119 @@
+import numpy as np
+
+from pymodaq.utils.daq_utils import ThreadCommand
+from pymodaq.utils.data import DataFromPlugins, Axis
+from pymodaq.control_modules.viewer_utility_classes import DAQ_Viewer_base, comon_parameters, main
+from pymodaq.utils.parameter import Parameter
+from pymodaq_plugins_keithley.hardware.KeithleyWrapper import acquire_controller, release_controller, \
+    BUFFER_MAX_POINTS
+from pymodaq_plugins_keithley.hardware.plugin_settings import config_params, update_visa_list, apply_config, \
+    configure, CONFIG_SETTERS
+from pymodaq_plugins_keithley.hardware.multi_device import Keithley6487Group
+
+
+class DAQ_1DViewer_Keithley_6487_Multi(DAQ_Viewer_base):
+    """Time traces of several Keithley 6487 acquiring in parallel
+
+    Each grab triggers all the selected instruments, fetches their buffers concurrently and returns the currents,
+    resampled on a common time axis, as a single Data1D (one channel per instrument).
+    """
+
+    params = comon_parameters + [
+        {'title': 'VISA:', 'name': 'visas', 'type': 'itemselect', 'value': dict(all_items=[], selected=[])},
+        {'title': 'Refresh VISA list', 'name': 'refresh_visa', 'type': 'bool_push', 'value': False, 'label': 'Refresh'},
+        {'title': 'Timeout (ms):', 'name': 'timeout', 'type': 'int', 'value': 10000, 'default': 10000, 'min': 2000},
+        {'title': 'Configuration:', 'name': 'config', 'type': 'group', 'children':
+            config_params('range', 'nplc', 'zerocheck')},
+        {'title': 'Readings per grab:', 'name': 'npoints', 'type': 'int', 'value': 100, 'default': 100, 'min': 1, 'max': BUFFER_MAX_POINTS},
+    ]
+
+    def ini_attributes(self):
+        self.controller: Keithley6487Group = None
+
+        update_visa_list(self.settings.child('visas'))
+
+    def commit_settings(self, param: Parameter):
+        """Apply the consequences of a change of value in the detector settings
+
+        Parameters
+        ----------
+        param: Parameter
+            A given parameter (within detector_settings) whose value has been changed by the user
+        """
+        if param.name() == 'refresh_visa':
+            update_visa_list(self.settings.child('visas'), refresh=True)
+        elif param.name() in CONFIG_SETTERS:
+            apply_config(self.controller.controllers, param.name(), param.value())
+
+    def ini_detector(self, controller=None):
+        """Detector communication initialization
+
+        Parameters
+        ----------
+        controller: (object)
+            custom object of a PyMoDAQ plugin (Slave case). None if only one actuator/detector by controller
+            (Master case)
+
+        Returns
+        -------
+        info: str
+        initialized: bool
+            False if initialization failed otherwise True
+        """
+        visas = self.settings.child('visas').value()['selected']
+        if len(visas) == 0:
+            return "No VISA resource selected", False
+
+        controllers = [acquire_controller(visa_resource=visa, timeout=self.settings.child('timeout').value())
+                       for visa in visas]
+        self.ini_detector_init(old_controller=controller,
+                               new_controller=Keithley6487Group(controllers))
+
+        for keithley_6487 in controllers:
+            configure(keithley_6487, self.settings.child('config'))  # a single bus transaction per instrument
+
+        self.data_grabed_signal_temp.emit([DataFromPlugins(name='Keithley_6487_Multi',
+                                                           data=[np.zeros(self.settings.child('npoints').value())
+                                                                 for _ in visas],
+                                                           dim='Data1D',
+                                                           labels=visas)])
+
+        info = f"Initialized - {len(visas)} instruments"
+        initialized = True
+        return info, initialized
+
+    def close(self):
+        """Terminate the communication protocol"""
+        for keithley_6487 in self.controller.controllers:
+            release_controller(keithley_6487)
+        self.controller.close()
+
+    def grab_data(self, Naverage=1, **kwargs):
+        """Acquire the readings on all instruments and emit them on a common time axis
+
+        Parameters
+        ----------
+        Naverage: int
+            Number of hardware averaging (not relevant here)
+        kwargs: dict
+            others optionals arguments
+        """
+        times, currents = self.controller.read_aligned(self.settings.child('npoints').value())
+        if len(times) == 0:  # Aborted
+            return
+        self.data_grabed_signal.emit([DataFromPlugins(name='Keithley_6487_Multi',
+                                                      data=list(currents),
+                                                      dim='Data1D',
+                                                      labels=self.settings.child('visas').value()['selected'],
+                                                      axes=[Axis('time', units='s', data=times, index=0)])])
+
+    def stop(self):
+        """Stop the current grab hardware wise if necessary"""
+        for keithley_6487 in self.controller.controllers:
+            keithley_6487.abort()
+        self.emit_status(ThreadCommand('Update_Status', ['Acquisition aborted']))
+        return ''
+
+
+if __name__ == '__main__':
+    main(__file__)
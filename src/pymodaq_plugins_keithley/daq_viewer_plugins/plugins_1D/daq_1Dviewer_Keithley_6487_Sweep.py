@@ -0,0 +1,119 @@
+import numpy as np
+
+from pymodaq.utils.daq_utils import ThreadCommand
+from pymodaq.utils.data import DataFromPlugins, Axis
+from pymodaq.control_modules.viewer_utility_classes import DAQ_Viewer_base, comon_parameters, main
+from pymodaq.utils.parameter import Parameter
+from pymodaq_plugins_keithley.hardware.KeithleyWrapper import Keithley6487Wrapper, release_controller
+from pymodaq_plugins_keithley.hardware.plugin_settings import DEFAULT_VISA, visa_params, config_params, \
+    update_visa_list, ini_controller, apply_config, configure, CONFIG_SETTERS
+
+
+class DAQ_1DViewer_Keithley_6487_Sweep(DAQ_Viewer_base):
+    """I-V curve from the Keithley 6487 built-in voltage sweep
+
+    Each grab runs the whole staircase sweep on the instrument and returns the current versus the measured source
+    voltage as a single Data1D.
+    """
+
+    params = comon_parameters + visa_params(timeout=60000) + [
+        {'title': 'Configuration:', 'name': 'config', 'type': 'group', 'children':
+            config_params('range', 'nplc', 'zerocheck', 'source_range')},
+        {'title': 'Sweep:', 'name': 'sweep', 'type': 'group', 'children':
+            [
+            {'title': 'Start (V):', 'name': 'start', 'type': 'float', 'value': 0.0, 'default': 0.0},
+            {'title': 'Stop (V):', 'name': 'stop', 'type': 'float', 'value': 1.0, 'default': 1.0},
+            {'title': 'Step (V):', 'name': 'step', 'type': 'float', 'value': 0.1, 'default': 0.1, 'min': 0.0002},
+            {'title': 'Delay (s):', 'name': 'delay', 'type': 'float', 'value': 0.0, 'default': 0.0, 'min': 0.0},
+            ]
+        },
+    ]
+
+    def ini_attributes(self):
+        self.controller: Keithley6487Wrapper = None
+
+        update_visa_list(self.settings.child('visa'))
+        self.settings.child('visa').setValue(DEFAULT_VISA)
+
+    def commit_settings(self, param: Parameter):
+        """Apply the consequences of a change of value in the detector settings
+
+        Parameters
+        ----------
+        param: Parameter
+            A given parameter (within detector_settings) whose value has been changed by the user
+        """
+        if param.name() == 'refresh_visa':
+            update_visa_list(self.settings.child('visa'), refresh=True)
+        elif param.name() in CONFIG_SETTERS:
+            apply_config([self.controller], param.name(), param.value())
+
+    def ini_detector(self, controller=None):
+        """Detector communication initialization
+
+        Parameters
+        ----------
+        controller: (object)
+            custom object of a PyMoDAQ plugin (Slave case). None if only one actuator/detector by controller
+            (Master case)
+
+        Returns
+        -------
+        info: str
+        initialized: bool
+            False if initialization failed otherwise True
+        """
+        self.ini_detector_init(old_controller=controller,
+                               new_controller=ini_controller(self.settings))
+
+        dvc = self.controller.get_device_infos()
+        self.settings.child('id').setValue(dvc)
+
+        configure(self.controller, self.settings.child('config'))
+
+        self.data_grabed_signal_temp.emit([DataFromPlugins(name='Keithley_6487_IV',
+                                                           data=[np.zeros(2)],
+                                                           dim='Data1D',
+                                                           labels=['I'])])
+
+        info = f"Initialized - {self.settings.child('controller_status').value()} {dvc}"
+        initialized = True
+        return info, initialized
+
+    def close(self):
+        """Terminate the communication protocol"""
+        if self.settings.child('controller_status').value() == "Master":
+            release_controller(self.controller)
+
+    def grab_data(self, Naverage=1, **kwargs):
+        """Run the sweep and emit the I-V curve
+
+        Parameters
+        ----------
+        Naverage: int
+            Number of hardware averaging (not relevant here)
+        kwargs: dict
+            others optionals arguments
+        """
+        readings = self.controller.sweep_voltage(start=self.settings.child('sweep', 'start').value(),
+                                                 stop=self.settings.child('sweep', 'stop').value(),
+                                                 step=self.settings.child('sweep', 'step').value(),
+                                                 delay=self.settings.child('sweep', 'delay').value())
+        if len(readings) == 0:  # Aborted
+            return
+        self.data_grabed_signal.emit([DataFromPlugins(name='Keithley_6487_IV',
+                                                      data=[readings['current']],
+                                                      dim='Data1D',
+                                                      labels=['I'],
+                                                      axes=[Axis('Vsource', units='V', data=readings['vsource'],
+                                                                 index=0)])])
+
+    def stop(self):
+        """Stop the current grab hardware wise if necessary"""
+        self.controller.abort()
+        self.emit_status(ThreadCommand('Update_Status', ['Sweep aborted']))
+        return ''
+
+
+if __name__ == '__main__':
+    main(__file__)
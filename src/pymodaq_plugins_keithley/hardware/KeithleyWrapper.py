@@ -1,17 +1,104 @@
+import os
 import threading
 import struct
+import time
+from contextlib import contextmanager
 
 from pyvisa import ResourceManager
 import numpy as np
 
+from pymodaq_plugins_keithley.hardware.ring_buffer import RingBuffer
+from pymodaq_plugins_keithley.hardware.profiling import TransactionProfiler, ProfiledResource, ProfiledLock
+from pymodaq_plugins_keithley.hardware.clock import ClockOffsetEstimator
+
+# With FORM:DATA REAL and FORM:ELEM ALL every reading is: current (float), unit (1 byte), timestamp (float),
+# status (float) and source voltage (float), big endian
+READING_FORMAT = '>fcfff'
+READING_SIZE = struct.calcsize(READING_FORMAT)
+READING_DTYPE = np.dtype([('current', '>f4'),
+                          ('unit', 'S1'),
+                          ('time', '>f4'),
+                          ('status', '>f4'),
+                          ('vsource', '>f4')])
+# Readings as returned by fetch_buffer, their timestamps shifted to the instrument timer: a float32 only resolves
+# 7.8 ms after 18 h of timer, so the time is a float64
+TIMED_READING_DTYPE = np.dtype([('current', '>f4'),
+                                ('unit', 'S1'),
+                                ('time', 'f8'),
+                                ('status', '>f4'),
+                                ('vsource', '>f4')])
+BUFFER_MAX_POINTS = 3000
+AVERAGE_MAX_COUNT = 100
+STB_EVENT_SUMMARY = 0x20
+BLOCK_CHUNK_SIZE = 20 * 1024
+STATUS_OVERFLOW = 0x01  # Overflow bit of the status element of a reading
+POLL_INTERVAL = 0.01  # Status byte polling interval in s while waiting for an acquisition
+STOP_POLL_INTERVAL = 0.1  # Interval in s between the aborts sent while stopping a Keithley6487Streamer
+LINE_FREQUENCIES = (50.0, 60.0)  # Hz, bounding the duration of one power line cycle
+BATCH_MAX_LENGTH = 250  # Characters per batched message, conservatively within the instrument input buffer
+
+# Current ranges from the largest to the smallest, and their full scale in A
+CURRENT_RANGES = {"20mA": 2e-2,
+                  "2mA": 2e-3,
+                  "200uA": 2e-4,
+                  "20uA": 2e-5,
+                  "2uA": 2e-6,
+                  "200nA": 2e-7,
+                  "20nA": 2e-8,
+                  "2nA": 2e-9}
+
+
+def parse_block_header(vals: bytes) -> tuple:
+    """Parse the IEEE-488.2 block header of a binary response
+
+    Returns
+    -------
+    offset: int
+        index of the first payload byte
+    length: int or None
+        payload length in bytes for a definite length block (#<n><length>), None for an indefinite one (#0)
+    """
+    if len(vals) < 2 or vals[0:1] != b'#':
+        raise ValueError(f"Invalid binary block header: {bytes(vals[:12])!r}")
+    ndigits = int(vals[1:2])
+    if ndigits == 0:
+        return 2, None
+    return 2 + ndigits, int(vals[2:2 + ndigits])
+
+
+def decode_readings(vals: bytes, npoints: int = None) -> np.recarray:
+    """Map a binary block of REAL,32 readings onto a record array without copying
+
+    Parameters
+    ----------
+    vals: bytes
+        raw response, including the block header and possibly the read termination
+    npoints: int
+        number of readings to decode, by default all the complete readings in the payload
+
+    Returns
+    -------
+    np.recarray with fields current, unit, time, status and vsource (big endian, read-only view on vals)
+    """
+    offset, length = parse_block_header(vals)
+    if length is None:
+        length = len(vals) - offset
+    available = length // READING_SIZE
+    if npoints is None:
+        npoints = available
+    elif npoints > available:
+        raise ValueError(f"Expected {npoints} readings but the payload only holds {available}")
+    return np.frombuffer(vals, dtype=READING_DTYPE, count=npoints, offset=offset).view(np.recarray)
+
 
 class Keithley6487Wrapper:
 
-    def __init__(self, visa_resource: str, timeout: int = 1000, ):
+    def __init__(self, visa_resource: str, timeout: int = 1000, visa_rm: ResourceManager = None):
         self.status = None
         self.time = None
         self.unit = None
-        self.visa_rm = ResourceManager()
+        self.visa_resource = visa_resource
+        self.visa_rm = visa_rm if visa_rm is not None else ResourceManager()
         # Init timeout
         self.resource = self.visa_rm.open_resource(visa_resource)
         self.resource.write_termination = '\n'
@@ -22,86 +109,814 @@ class Keithley6487Wrapper:
         self.current_V: float = 0.0
         self.current_I: float = 0.0
         self.measurement_obsolete: bool = True
+        self.configured: bool = False
+        self.refcount: int = 0  # Number of plugins sharing this controller, see acquire_controller
+        self._state: dict = {}  # Shadow copy of the instrument settings, see write_setting
+        self.profiler: TransactionProfiler = None
+        self.clock = ClockOffsetEstimator()  # Instrument timestamps to host time, fed by every received reading
+        self._trigger_time = self.clock.clock()  # Host time of the last INIT, see _buffer_origin
+        self._batch: list = None  # Commands waiting to be sent, only while a batch is open, see batch
 
-        self.lock = threading.Lock()
+        self.lock = threading.RLock()
+        self._abort_event = threading.Event()
+        self._pending: tuple = (1, 0.0)  # (npoints, extra time in s) of the last INIT, see _initiate
+        self._idle = threading.Event()  # Cleared from an INIT until its readings are fetched, see _idle_lock
+        self._idle.set()
+        self._busy_until: float = 0.0
+        self.acquisition_error: Exception = None  # Last exception raised in the start_acquisition waiter
 
     def get_device_infos(self) -> str:
         with self.lock:
-            dvc = self.resource.query("*IDN?")
+            dvc = self.query("*IDN?")
         return dvc
 
+    def write(self, command: str):
+        """Send command, or queue it if a batch is open (a query flushes the batch so that its response can be read)"""
+        with self.lock:
+            if self._batch is None:
+                self.resource.write(command)
+                return
+            self._batch.append(command)
+            if command.rstrip().endswith('?'):
+                self.flush()
+
+    def query(self, command: str) -> str:
+        with self.lock:
+            self.write(command)
+            return self.resource.read()
+
+    def flush(self):
+        """Send the commands queued by the open batch as semicolon joined messages of at most BATCH_MAX_LENGTH"""
+        with self.lock:
+            if not self._batch:
+                return
+            message = ''
+            for command in self._batch:
+                if not command.startswith((':', '*')):
+                    command = ':' + command  # Back to the root of the command tree, whatever the previous command
+                if message and len(message) + 1 + len(command) > BATCH_MAX_LENGTH:
+                    self.resource.write(message)
+                    message = command
+                else:
+                    message = f"{message};{command}" if message else command
+            self.resource.write(message)
+            self._batch.clear()
+
+    @contextmanager
+    def batch(self, opc: bool = False):
+        """Accumulate the commands written in the context and send them together when leaving it
+
+        The lock is held for the whole context. Settings writes are still filtered by the shadow state (see
+        write_setting) and a query sends the pending commands along with it. Nested batches are part of the outermost
+        one.
+
+        Parameters
+        ----------
+        opc: bool
+            if True, end the batch with *OPC? and wait for the instrument to have executed all the commands
+        """
+        with self.lock:
+            if self._batch is not None:
+                yield
+                return
+            self._batch = []
+            try:
+                yield
+                if opc:
+                    self.query("*OPC?")
+            finally:
+                self.flush()
+                self._batch = None
+
     def reset(self) -> None:
-        self.resource.write("*rst; status:preset; *cls;")
+        with self.batch():
+            self.write("*RST")
+            self.write("STAT:PRES")
+            self.write("*CLS")
+            self.invalidate()
+
+    def write_setting(self, key: str, value, command: str):
+        """Write command only if the instrument is not already known to hold value for the setting key"""
+        with self.lock:
+            if key in self._state and self._state[key] == value:
+                return
+            self.write(command)
+            self._state[key] = value
+
+    def invalidate(self, key: str = None):
+        """Forget the shadow value of the setting key (of all settings if None), forcing the next write"""
+        if key is None:
+            self._state.clear()
+        else:
+            self._state.pop(key, None)
+
+    def setup(self, force: bool = False):
+        """Reset and configure current measurements with binary readings, only once per session unless forced"""
+        if self.configured and not force:
+            return
+        with self.batch(opc=True):
+            self.reset()
+            self.config_mode('CURR')
+            self.config_reading()
+        self.configured = True
 
     def config_mode(self, mode: str = None):
         if mode not in ['CURR', 'VOLT', 'RES', 'CHAR']:
             raise ValueError(f"{mode} not in ['CURR','VOLT','RES','CHAR']")
 
-        self.resource.write(f"CONF:{mode}")
+        self.write_setting('mode', mode, f"CONF:{mode}")
 
     def config_zerocheck(self, active: bool = False):
         if active:
-            self.resource.write("SYST:ZCHeck ON")
+            self.write_setting('zerocheck', True, "SYST:ZCHeck ON")
         else:
-            self.resource.write("SYST:ZCHeck OFF")
+            self.write_setting('zerocheck', False, "SYST:ZCHeck OFF")
 
     def config_reading(self):
-        self.resource.write(f"FORM:DATA REAL")
-        self.resource.write(f"FORM:ELEM ALL")
+        self.write_setting('format_data', 'REAL', f"FORM:DATA REAL")
+        self.write_setting('format_elements', 'ALL', f"FORM:ELEM ALL")
 
     def set_nplc(self, nplc: float = 5.0):
-        self.resource.write(f"CURR: NPLC {nplc}")
+        self.write_setting('nplc', nplc, f"CURR:NPLC {nplc}")
 
     def set_range(self, rangecurrent: str = "20mA"):
-        rngexp = {"20mA": -2,  # 2e-2
-                  "2mA": -3,  # 2e-3
-                  "200uA": -4,  # 2e-4
-                  "20uA": -5,  # 2e-5
-                  "2uA": -6,  # 2e-6
-                  "200nA": -7,  # 2e-7
-                  "20nA": -8,  # 2e-8
-                  "2nA": -9}  # 2e-9
+        if rangecurrent not in CURRENT_RANGES:
+            raise ValueError(f"{rangecurrent} not in {list(CURRENT_RANGES)}")
+
+        self.write_setting('range', rangecurrent, f"CURR:RANG {CURRENT_RANGES[rangecurrent]:.0E}")
 
-        self.resource.write(f"CURR:RANG 2E-{rngexp[rangecurrent]}")
+    def get_setting(self, key: str):
+        """Last value written for the setting key (see write_setting), None if unknown"""
+        return self._state.get(key)
 
     def set_source_voltage(self, volts: float = 0.0):
-        self.resource.write(f"SOUR:VOLT {volts}")
+        self.write_setting('source_voltage', volts, f"SOUR:VOLT {volts}")
+        self.measurement_obsolete = True
 
     def set_source_range(self, range_s: int = 10):
         if range_s not in [10, 50, 500]:
             raise ValueError(f"range {range_s} not in [10,50,500]")
         else:
-            self.resource.write(f"SOUR:VOLT:RANGe {range_s}")
+            self.write_setting('source_range', range_s, f"SOUR:VOLT:RANGe {range_s}")
 
     def operate_source(self, oper: bool = False):
         if oper:
-            self.resource.write("SOURce:VOLT:STATe ON")
+            self.write_setting('source_operate', True, "SOURce:VOLT:STATe ON")
         else:
-            self.resource.write("SOURce:VOLT:STATe OFF")
+            self.write_setting('source_operate', False, "SOURce:VOLT:STATe OFF")
+        self.measurement_obsolete = True
+
+    def expected_duration(self, npoints: int = 1, line_frequency: float = min(LINE_FREQUENCIES)) -> float:
+        """Integration time in s of npoints readings with the NPLC and filter count last written"""
+        nplc = self.get_setting('nplc') or 6.0  # *RST value, the largest of the 50 and 60 Hz defaults
+        count = self.get_setting('average_count') if self.get_setting('average') else 1
+        return npoints * nplc * count / line_frequency
+
+    def _time_limit(self, npoints: int, extra_time: float = 0.0) -> float:
+        """Time in s after which an acquisition of npoints readings is considered failed"""
+        return 1.5 * (self.expected_duration(npoints) + extra_time) + self.resource.timeout / 1000
+
+    @contextmanager
+    def _idle_lock(self):
+        """Hold the lock once the acquisition started by another call (if any) has been fetched
+
+        To be used around the commands triggering readings (or reconfiguring the trigger model), so that they do not
+        break the acquisition of another plugin sharing this controller. An acquisition still pending past its time
+        limit (e.g. triggered but never fetched) is given up.
+        """
+        while True:
+            self.lock.acquire()
+            if self._idle.is_set() or time.perf_counter() > self._busy_until:
+                break
+            self.lock.release()
+            self._idle.wait(max(0.0, self._busy_until - time.perf_counter()))
+        try:
+            yield
+        finally:
+            self.lock.release()
+
+    @contextmanager
+    def exclusive(self):
+        """Hold the lock, once idle, for a sequence of calls that other threads should not interleave
+
+        e.g. from trigger_buffer to wait_and_fetch_buffer, the status byte polls then not releasing the lock
+        """
+        with self._idle_lock():
+            yield
+
+    def _initiate(self, npoints: int, extra_time: float = 0.0):
+        """INIT the trigger model followed by *OPC, to be waited for with _wait_done
+
+        The controller is busy (see _idle_lock) until the readings are fetched or the acquisition is aborted.
+        """
+        self.write("*CLS")
+        # Operation complete sets the event summary bit of the status byte
+        self.write_setting('event_enable', 1, "*ESE 1")
+        self.write("INIT")
+        self.write("*OPC")
+        self._trigger_time = self.clock.clock()
+        self._abort_event = threading.Event()
+        self._pending = (npoints, extra_time)
+        self._idle.clear()
+        self._busy_until = time.perf_counter() + self._time_limit(npoints, extra_time)
+
+    def _wait_done(self, poll_interval: float = POLL_INTERVAL) -> bool:
+        """Wait for the operation started by _initiate by polling the status byte, so that the wait is not bound by
+        the VISA timeout and the lock is only held while polling
+
+        Returns
+        -------
+        bool: False if the wait was aborted (see abort)
+
+        Raises
+        ------
+        TimeoutError: if the operation is not done 50% (plus the VISA timeout) after its expected duration
+        """
+        npoints, extra_time = self._pending
+        abort_event = self._abort_event
+        with self.lock:
+            self.flush()
+        start = time.perf_counter()
+        deadline = start + self._time_limit(npoints, extra_time)
+        # Nothing to poll for before the shortest possible duration
+        if abort_event.wait(self.expected_duration(npoints, max(LINE_FREQUENCIES)) + extra_time):
+            return False
+        while True:
+            with self.lock:
+                if self.resource.read_stb() & STB_EVENT_SUMMARY:
+                    self.query("*ESR?")  # Clear the standard event register
+                    return True
+            if time.perf_counter() > deadline:
+                raise TimeoutError(f"Acquisition of {npoints} readings not done after {deadline - start:.1f} s")
+            if abort_event.wait(poll_interval):
+                return False
 
     def read_current_and_vsource(self):
+        """Trigger and read a single reading
+
+        Readings much shorter than the VISA timeout are read with a single READ?, longer ones (e.g. with a large
+        filter count) are waited for by polling the status byte and fetched. [I, Vsource] of the previous reading are
+        returned if the wait is aborted.
+        """
+        with self._idle_lock(), self.batch():
+            self.config_single()
+            if self.expected_duration(1) < self.resource.timeout / 2000:
+                self.write('READ?')
+                return self._update_last_reading(decode_readings(self.read_block(1), 1))
+            self._initiate(1)
+        try:
+            if not self._wait_done():
+                return [self.current_I, self.current_V]
+            return self.fetch_current_and_vsource()
+        finally:
+            self._idle.set()
+
+    def set_and_measure(self, volts: float, settling_time: float = 0.0, tolerance: float = None,
+                        max_readings: int = 10) -> list:
+        """Set the source voltage and measure [I, Vsource] once it has settled, in a single locked transaction
+
+        Without settling time, the voltage setting and the READ? are sent in the same bus message. With a tolerance,
+        the reading is repeated (at most max_readings times) until Vsource is within tolerance of volts, the last
+        reading being returned anyway.
+
+        Parameters
+        ----------
+        volts: float
+            source voltage in V
+        settling_time: float
+            time in s to wait between the voltage setting and the first reading
+        tolerance: float
+            maximum difference in V between the measured Vsource and volts, None to accept the first reading
+        max_readings: int
+        """
+        with self._idle_lock():
+            with self.batch():
+                self.set_source_voltage(volts)
+                if settling_time > 0:
+                    self.flush()
+                    time.sleep(settling_time)
+                ret = self.read_current_and_vsource()
+            for _ in range(max_readings - 1):
+                if tolerance is None or abs(ret[1][0] - volts) <= tolerance:
+                    break
+                ret = self.read_current_and_vsource()
+        return ret
+
+    def fetch_current_and_vsource(self):
+        """Fetch the latest reading without triggering a new one (to be used after start_acquisition)"""
         with self.lock:
-            self.resource.write('READ?')
-            vals = self.resource.read_raw()
-            while len(vals) < 20:
-                vals = vals + self.resource.read_raw()
+            self.write('FETC?')
+            readings = decode_readings(self.read_block(1), 1)
+
+        return self._update_last_reading(readings)
+
+    def read_block(self, npoints: int) -> bytearray:
+        """Read a binary block response of npoints readings into a preallocated buffer
+
+        The size of the response is known up front from npoints (and checked against the IEEE-488.2 header for a
+        definite length block), so it is read in chunks straight into its final place, usually with a single read.
+        Raises ValueError if the framing is not the expected one, e.g. because the reading elements changed, after
+        clearing the rest of the response so that the next read starts on a new one.
+
+        Returns
+        -------
+        bytearray: the whole block, header and read termination included, to be decoded with decode_readings
+        """
+        termination = self.resource.read_termination.encode()
+        length = npoints * READING_SIZE
+        vals = bytearray(2 + length + len(termination))  # Indefinite length block: #0<payload><termination>
+        position = min(len(vals), BLOCK_CHUNK_SIZE)
+        self._read_into(vals, 0, position)
 
-        # In the Keithley Language, the first two bytes are the buffer header so we skip it
-        # buffer header = struct.unpack('>f',vals[2:6])
-        self.current_I = np.array(struct.unpack('>f', vals[2:6]))  # Then we have measured current
+        if vals[0:1] != b'#' or not vals[1:2].isdigit():
+            raise self._framing_error(f"Invalid binary block header: {bytes(vals[:12])!r}")
+        ndigits = int(vals[1:2])
+        if ndigits > 0:
+            vals = vals + bytearray(ndigits)
+            block_length = parse_block_header(vals)[1]
+            if block_length != length:
+                raise self._framing_error(f"Expected {npoints} readings ({length} bytes) but got {block_length} bytes")
+        self._read_into(vals, position, len(vals))
 
-        self.unit = struct.unpack('c', vals[6:7])  # Then we have 1 byte for unit (it's A)
-        self.time = struct.unpack('>f', vals[7:11])  # Then a float for measurement time
-        self.status = struct.unpack('>f', vals[11:15])  # Then a float for status (0 if no error)
+        if vals[len(vals) - len(termination):] != termination:
+            raise self._framing_error(f"Binary block of {npoints} readings not followed by the read termination")
+        return vals
 
-        self.current_V = np.array(struct.unpack('>f', vals[15:19]))  # Finally the voltage at source
+    def _framing_error(self, message: str) -> ValueError:
+        self.resource.clear()  # Device clear, discarding the unread part of the response
+        return ValueError(message)
+
+    def _read_into(self, vals: bytearray, start: int, stop: int):
+        with memoryview(vals) as view:
+            while start < stop:
+                chunk = self.resource.read_bytes(min(BLOCK_CHUNK_SIZE, stop - start))
+                view[start:start + len(chunk)] = chunk
+                start += len(chunk)
+
+    def _update_last_reading(self, readings: np.recarray) -> list:
+        self.clock.add(float(readings.time[-1]))
+        self.current_I = np.array([readings.current[-1]], dtype=float)
+        self.unit = readings.unit[-1]
+        self.time = float(readings.time[-1])
+        self.status = float(readings.status[-1])
+        self.current_V = np.array([readings.vsource[-1]], dtype=float)
 
         self.measurement_obsolete = False
         ret = [self.current_I, self.current_V]
         return ret
 
+    def config_buffer(self, npoints: int = 100):
+        """Arm the trace buffer and the trigger model to store npoints readings on the next INIT"""
+        if not 1 <= npoints <= BUFFER_MAX_POINTS:
+            raise ValueError(f"npoints {npoints} not in [1, {BUFFER_MAX_POINTS}]")
+
+        with self.lock:
+            self.write("TRAC:CLE")
+            self.write_setting('trace_points', npoints, f"TRAC:POIN {npoints}")
+            self.write_setting('trace_feed', 'SENS', "TRAC:FEED SENS")
+            self.write("TRAC:FEED:CONT NEXT")  # Goes back to NEVer by itself once the buffer is full
+            # Each timestamp relative to the first buffered reading (not to the previous one), see _buffer_origin
+            self.write_setting('timestamp_format', 'ABS', "TRAC:TST:FORM ABS")
+            self.write_setting('arm_count', 1, "ARM:COUN 1")
+            self.write_setting('trigger_count', npoints, f"TRIG:COUN {npoints}")
+
+    def config_single(self):
+        """Go back to one reading per trigger"""
+        self.write_setting('arm_count', 1, "ARM:COUN 1")
+        self.write_setting('trigger_count', 1, "TRIG:COUN 1")
+
+    def read_buffer(self, npoints: int = 100) -> np.recarray:
+        """Acquire npoints readings in the instrument buffer and fetch them in a single binary transfer
+
+        Returns
+        -------
+        np.recarray: see fetch_buffer, empty if the acquisition was aborted
+        """
+        self.trigger_buffer(npoints)
+        return self.wait_and_fetch_buffer(npoints)
+
+    def trigger_buffer(self, npoints: int = 100):
+        """Start the acquisition of npoints readings in the trace buffer without waiting for it"""
+        with self._idle_lock(), self.batch():
+            self.config_buffer(npoints)
+            self._initiate(npoints)
+
+    def wait_and_fetch_buffer(self, npoints: int) -> np.recarray:
+        """Wait for the acquisition started by trigger_buffer to be done and fetch its readings
+
+        Returns
+        -------
+        np.recarray: see fetch_buffer, empty if the acquisition was aborted
+        """
+        try:
+            if not self._wait_done():
+                return np.zeros(0, dtype=TIMED_READING_DTYPE).view(np.recarray)
+            return self.fetch_buffer(npoints)
+        finally:
+            self._idle.set()
+
+    def fetch_buffer(self, npoints: int) -> np.recarray:
+        """Fetch npoints readings from the trace buffer in a single binary transfer
+
+        Their timestamps are shifted by _buffer_origin, so that they follow the instrument timer as the ones of
+        READ? and FETC? instead of restarting from 0 with each buffer.
+
+        Returns
+        -------
+        np.recarray: fields of TIMED_READING_DTYPE, the time being a float64 (see decode_readings for the others)
+        """
+        with self.lock:
+            self.write("TRAC:DATA?")
+            block = decode_readings(self.read_block(npoints), npoints)
+            origin = self._buffer_origin(block)
+
+        readings = block.astype(TIMED_READING_DTYPE).view(np.recarray)
+        readings['time'] += origin  # In float64, the block relative float32 timestamps keep their resolution
+        self._update_last_reading(readings)
+        return readings
+
+    def _buffer_origin(self, block: np.recarray) -> float:
+        """Instrument timer at the last INIT, estimated from the host time it was sent
+
+        The first buffered reading is stamped 0, its actual timer value being later by the bus latency and one
+        integration time. Until a reading has been received the clock offset is unknown: the readings of block are then
+        fetched again with FETC?, which stamps them on the instrument timer, and the origin is exactly the one of block.
+        """
+        if self.clock.ready:
+            return float(self.clock.to_instrument(self._trigger_time))
+        self.write("FETC?")
+        readings = decode_readings(self.read_block(len(block)), len(block))
+        return float(readings.time[-1]) - float(block.time[-1])
+
+    def sweep_voltage(self, start: float, stop: float, step: float, delay: float = 0.0) -> np.recarray:
+        """Run a linear staircase sweep of the voltage source on the instrument, one reading per step
+
+        The sweep is run by the instrument trigger model and the synchronized I/Vsource readings are fetched from the
+        trace buffer in a single transfer. The source is left operating.
+
+        Parameters
+        ----------
+        start, stop, step: float
+            sweep voltages in V, step being taken in absolute value
+        delay: float
+            source delay in s before each reading
+
+        Returns
+        -------
+        np.recarray: see fetch_buffer
+        """
+        if step == 0:
+            raise ValueError("step should not be 0")
+        npoints = int(round(abs(stop - start) / abs(step))) + 1
+        if npoints > BUFFER_MAX_POINTS:
+            raise ValueError(f"{npoints} points sweep larger than the buffer ({BUFFER_MAX_POINTS})")
+
+        with self._idle_lock(), self.batch():
+            self.config_buffer(npoints)
+            self.write(f"SOUR:VOLT:SWE:STAR {start}")
+            self.write(f"SOUR:VOLT:SWE:STOP {stop}")
+            self.write(f"SOUR:VOLT:SWE:STEP {abs(step)}")
+            self.write(f"SOUR:VOLT:SWE:DEL {delay}")
+            self.operate_source(True)
+            self.write("SOUR:VOLT:SWE:INIT")
+            self._initiate(npoints, extra_time=npoints * delay)
+            self.invalidate('source_voltage')
+        return self.wait_and_fetch_buffer(npoints)
+
+    def sweep_voltage_list(self, volts, delay: float = 0.0) -> np.recarray:
+        """Measure the current at each voltage of volts
+
+        Evenly spaced voltages are run as an instrument sweep (see sweep_voltage), other lists are stepped point by
+        point while keeping the lock for the whole sequence.
+        """
+        volts = np.asarray(volts, dtype=float)
+        steps = np.diff(volts)
+        if len(volts) > 1 and steps[0] != 0 and np.allclose(steps, steps[0]):
+            return self.sweep_voltage(volts[0], volts[-1], steps[0], delay=delay)
+
+        readings = np.zeros(len(volts), dtype=TIMED_READING_DTYPE).view(np.recarray)
+        with self._idle_lock():
+            self.operate_source(True)
+            for ind, volt in enumerate(volts):
+                self.set_source_voltage(volt)
+                time.sleep(delay)
+                self.read_current_and_vsource()
+                readings[ind] = (self.current_I[0], self.unit, self.time, self.status, self.current_V[0])
+        return readings
+
+    def set_average(self, count: int = 1):
+        """Configure the repeating digital filter so that each reading is the average of count conversions"""
+        if not 1 <= count <= AVERAGE_MAX_COUNT:
+            raise ValueError(f"count {count} not in [1, {AVERAGE_MAX_COUNT}]")
+        if count == 1:
+            self.write_setting('average', False, "AVER OFF")
+        else:
+            self.write_setting('average_control', 'REP', "AVER:TCON REP")
+            self.write_setting('average_count', count, f"AVER:COUN {count}")
+            self.write_setting('average', True, "AVER ON")
+
+    def read_average(self, naverage: int = 1) -> list:
+        """Averaged current and source voltage over naverage conversions
+
+        Up to AVERAGE_MAX_COUNT the instrument digital filter does the averaging and a single READ? is issued,
+        above the readings are acquired in the trace buffer and averaged with numpy.
+        """
+        if naverage <= AVERAGE_MAX_COUNT:
+            self.set_average(naverage)
+            return self.read_current_and_vsource()
+
+        self.set_average(1)
+        current = 0.0
+        vsource = 0.0
+        remaining = naverage
+        while remaining > 0:
+            npoints = min(remaining, BUFFER_MAX_POINTS)
+            readings = self.read_buffer(npoints)
+            if len(readings) == 0:  # Aborted
+                return [self.current_I, self.current_V]
+            current += np.sum(readings['current'], dtype=float)
+            vsource += np.sum(readings['vsource'], dtype=float)
+            remaining -= npoints
+
+        self.current_I = np.array([current / naverage])
+        self.current_V = np.array([vsource / naverage])
+        return [self.current_I, self.current_V]
+
+    def start_acquisition(self, callback, npoints: int = None, poll_interval: float = 0.05, error_callback=None):
+        """Trigger a measurement and return immediately
+
+        A waiter thread polls the status byte until the *OPC following INIT sets the event summary bit, then fetches
+        the data and calls callback with it. The lock is only held while talking to the instrument, so other plugins
+        sharing this controller can use it during the integration.
+
+        Parameters
+        ----------
+        callback: callable
+            called from the waiter thread with [I, Vsource] (npoints None) or the np.recarray of buffered readings
+        npoints: int
+            if not None, acquire npoints readings in the trace buffer
+        poll_interval: float
+            status byte polling interval in seconds
+        error_callback: callable
+            called from the waiter thread with the exception raised while waiting, fetching or in callback (it is
+            also kept in acquisition_error)
+        """
+        with self._idle_lock(), self.batch():
+            if npoints is not None:
+                self.config_buffer(npoints)
+            else:
+                self.config_single()
+            self._initiate(1 if npoints is None else npoints)
+
+        waiter = threading.Thread(target=self._wait_acquisition,
+                                  args=(callback, npoints, poll_interval, error_callback), daemon=True)
+        waiter.start()
+
+    def _wait_acquisition(self, callback, npoints: int, poll_interval: float, error_callback):
+        try:
+            try:
+                if not self._wait_done(poll_interval):
+                    return
+                if npoints is None:
+                    data = self.fetch_current_and_vsource()
+                else:
+                    data = self.fetch_buffer(npoints)
+            finally:
+                self._idle.set()
+            callback(data)
+        except Exception as e:
+            self.acquisition_error = e
+            if error_callback is not None:
+                error_callback(e)
+
     def abort(self):
-        self.resource.write("INIT:ABORt")
+        """Abort the running acquisition: its wait returns at the next status byte poll, then INIT:ABORt is sent"""
+        self._abort_event.set()
+        with self.batch():
+            self.write("INIT:ABORt")
+            self.write("TRAC:FEED:CONT NEV")
+        self._idle.set()
+
+    def enable_profiling(self, size: int = 10000) -> TransactionProfiler:
+        """Record the timing of the next size transactions and lock acquisitions, see the profiling module"""
+        if self.profiler is None:
+            self.profiler = TransactionProfiler(size)
+            self.resource = ProfiledResource(self.resource, self.profiler)
+            self.lock = ProfiledLock(self.lock, self.profiler)
+        return self.profiler
+
+    def disable_profiling(self):
+        """Go back to the bare resource and lock, the profiler (if any) keeps its records"""
+        if self.profiler is not None:
+            self.resource = self.resource.resource
+            self.lock = self.lock.lock
+            self.profiler = None
 
     def close(self):
         self.resource.close()
+
+
+_resource_manager: ResourceManager = None
+_controllers: dict = {}
+_registry_lock = threading.Lock()
+
+VISA_RESOURCES_TTL = 60.0
+SIMULATOR_ENV = 'KEITHLEY6487_SIMULATOR'  # Set to 1 to list the simulated instrument with the VISA resources
+_visa_resources: list = None
+_visa_resources_time: float = 0.0
+_visa_resources_lock = threading.Lock()
+
+
+def get_resource_manager() -> ResourceManager:
+    """Process wide VISA ResourceManager, created on first use"""
+    global _resource_manager
+    with _registry_lock:
+        if _resource_manager is None:
+            _resource_manager = ResourceManager()
+    return _resource_manager
+
+
+def list_visa_resources(refresh: bool = False, ttl: float = VISA_RESOURCES_TTL, include_simulated: bool = None) -> list:
+    """Available VISA resources, cached for all the plugins
+
+    Enumerating the buses is slow so it is only done on first call, when forced with refresh or when the cached list
+    is older than ttl seconds. The simulated instrument is appended if include_simulated, by default if the
+    SIMULATOR_ENV environment variable is set to a non zero value.
+    """
+    global _visa_resources, _visa_resources_time
+
+    with _visa_resources_lock:
+        if refresh or _visa_resources is None or time.monotonic() - _visa_resources_time > ttl:
+            _visa_resources = list(get_resource_manager().list_resources())
+            _visa_resources_time = time.monotonic()
+        resources = list(_visa_resources)
+
+    if include_simulated is None:
+        include_simulated = os.environ.get(SIMULATOR_ENV, '0') not in ('', '0')
+    if include_simulated:
+        from pymodaq_plugins_keithley.hardware.simulator import SimulatedResourceManager
+        resources += list(SimulatedResourceManager().list_resources())
+    return resources
+
+
+def acquire_controller(visa_resource: str, timeout: int = 1000) -> Keithley6487Wrapper:
+    """Reference counted controller shared by all the plugins talking to the same VISA resource
+
+    The first call opens the resource, the next ones return the same wrapper (hence the same session and lock), its
+    timeout being raised if needed. Each call should be balanced by a call to release_controller. Addresses starting
+    with SIMULATED_PREFIX open a simulated instrument (see the simulator module).
+    """
+    from pymodaq_plugins_keithley.hardware.simulator import SimulatedResourceManager, SIMULATED_PREFIX
+
+    if visa_resource.startswith(SIMULATED_PREFIX):
+        rm = SimulatedResourceManager()
+    else:
+        rm = get_resource_manager()
+    with _registry_lock:
+        controller = _controllers.get(visa_resource)
+        if controller is None:
+            controller = Keithley6487Wrapper(visa_resource, timeout=timeout, visa_rm=rm)
+            _controllers[visa_resource] = controller
+        elif controller.resource.timeout < timeout:
+            controller.resource.timeout = timeout
+        controller.refcount += 1
+    return controller
+
+
+def release_controller(controller: Keithley6487Wrapper):
+    """Release a controller obtained from acquire_controller, closing its session when no plugin uses it anymore"""
+    with _registry_lock:
+        controller.refcount -= 1
+        if controller.refcount > 0:
+            return
+        if _controllers.get(controller.visa_resource) is controller:
+            del _controllers[controller.visa_resource]
+    controller.close()
+
+
+class AutoRanger:
+    """Software autorange with hysteresis, remembering the last good range of each source voltage setpoint
+
+    The range goes up one step when a reading overflows or exceeds upper times the full scale and down one step when
+    it is below lower times the full scale. lower being well below upper / 10 (the ratio of two consecutive ranges), a
+    reading cannot make the range oscillate.
+    """
+
+    def __init__(self, upper: float = 0.9, lower: float = 0.05):
+        if not 0 < lower < upper / 10:
+            raise ValueError(f"lower threshold {lower} should be in ]0, upper / 10 = {upper / 10}[")
+        self.upper = upper
+        self.lower = lower
+        self.ranges = list(CURRENT_RANGES)
+        self.memory: dict = {}
+
+    def next_range(self, rangecurrent: str, current: float, status: float = 0) -> str:
+        """Range to switch to for a reading of current obtained on rangecurrent, None if it is a good one"""
+        ind = self.ranges.index(rangecurrent)
+        full_scale = CURRENT_RANGES[rangecurrent]
+        if int(status) & STATUS_OVERFLOW or abs(current) > self.upper * full_scale:
+            return self.ranges[ind - 1] if ind > 0 else None
+        if abs(current) < self.lower * full_scale and ind < len(self.ranges) - 1:
+            return self.ranges[ind + 1]
+        return None
+
+    def recall(self, setpoint: float) -> str:
+        return self.memory.get(setpoint)
+
+    def remember(self, setpoint: float, rangecurrent: str):
+        self.memory[setpoint] = rangecurrent
+
+    def clear(self):
+        self.memory.clear()
+
+
+class AdaptiveNPLC:
+    """Integration time of each reading chosen to reach a target signal to noise ratio, remembered per setpoint
+
+    The current noise is modelled as noise / sqrt(NPLC * count), noise (A rms at 1 NPLC) being refined from the
+    scatter of consecutive readings at the same setpoint, count being the number of conversions averaged in each
+    reading. The NPLC giving target_snr on the magnitude of a reading is used for the next reading at the same setpoint
+    and, until it has been measured, at any other one: integrations are short where the current is large and long near
+    zero crossings.
+    """
+
+    def __init__(self, target_snr: float = 100.0, min_nplc: float = 0.01, max_nplc: float = 10.0,
+                 noise: float = 1e-12, smoothing: float = 0.1):
+        if not 0 < min_nplc <= max_nplc:
+            raise ValueError(f"NPLC bounds [{min_nplc}, {max_nplc}] should be positive and ordered")
+        self.target_snr = target_snr
+        self.min_nplc = min_nplc
+        self.max_nplc = max_nplc
+        self.noise = noise
+        self.smoothing = smoothing
+        self.nplc = max_nplc  # for setpoints not measured yet
+        self.memory: dict = {}
+        self._last: tuple = None  # (setpoint, current, integration in NPLC) of the previous reading
+
+    def nplc_for(self, setpoint: float) -> float:
+        """NPLC to use for the next reading at setpoint"""
+        return self.memory.get(setpoint, self.nplc)
+
+    def update(self, current: float, nplc: float, setpoint: float = None, count: int = 1) -> float:
+        """Take into account a reading of current, average of count conversions of nplc each, at setpoint
+
+        Returns
+        -------
+        float: the NPLC of each of the count conversions of the next reading
+        """
+        integration = nplc * count
+        if self._last is not None and self._last[0] == setpoint:
+            _, last_current, last_integration = self._last
+            # mean absolute difference of two gaussian readings -> noise at 1 NPLC
+            scatter = np.sqrt(np.pi / 2) * abs(current - last_current) / np.sqrt(1 / integration + 1 / last_integration)
+            self.noise += self.smoothing * (scatter - self.noise)
+        self._last = (setpoint, current, integration)
+
+        required = (self.target_snr * self.noise / max(abs(current), 1e-30)) ** 2 / count
+        self.nplc = float(np.clip(float(f"{required:.2g}"), self.min_nplc, self.max_nplc))
+        self.memory[setpoint] = self.nplc
+        return self.nplc
+
+    def clear(self):
+        self.memory.clear()
+        self._last = None
+
+
+class Keithley6487Streamer(threading.Thread):
+    """Producer thread continuously draining buffered acquisitions of npoints readings into a RingBuffer
+
+    If a writer is given (e.g. a h5_writer.ChunkedH5Writer), each block is also appended to it. Any exception raised
+    while talking to the instrument or writing stops the stream and is kept in the error attribute.
+    """
+
+    def __init__(self, controller: Keithley6487Wrapper, ring: RingBuffer, npoints: int = 100, writer=None):
+        super().__init__(daemon=True)
+        self.controller = controller
+        self.ring = ring
+        self.npoints = npoints
+        self.writer = writer
+        self.error: Exception = None
+        self._stop_event = threading.Event()
+
+    def run(self):
+        try:
+            while not self._stop_event.is_set():
+                readings = self.controller.read_buffer(self.npoints)
+                if len(readings) == 0:  # Aborted
+                    continue
+                self.ring.extend(readings)
+                if self.writer is not None:
+                    self.writer.append(readings)
+        except Exception as e:
+            self.error = e
+
+    def stop(self, timeout: float = None):
+        """Stop the stream, aborting the block being acquired so that the join does not wait for it"""
+        self._stop_event.set()
+        end = None if timeout is None else time.perf_counter() + timeout
+        while True:
+            # Repeated in case a block was triggered just before the stop flag was seen
+            self.controller.abort()
+            self.join(STOP_POLL_INTERVAL if end is None else max(0.0, min(STOP_POLL_INTERVAL, end - time.perf_counter())))
+            if not self.is_alive() or (end is not None and time.perf_counter() >= end):
+                return
@@ -0,0 +1,130 @@
+"""asyncio interface to Keithley6487Wrapper, for orchestration scripts running outside of PyMoDAQ
+
+The blocking VISA calls run in a thread pool shared by all the instruments, so that awaiting several of them overlaps
+their I/O without a thread per device. Each instrument has its own command queue: its commands, settings writes as
+well as queries, are executed one at a time in the order they were awaited.
+
+Example::
+
+    async def main():
+        k1 = await AsyncKeithley6487.open('GPIB0::22::INSTR')
+        k2 = await AsyncKeithley6487.open('GPIB0::23::INSTR')
+        readings_1, readings_2 = await asyncio.gather(k1.read_buffer(1000), k2.read_buffer(1000))
+        await asyncio.gather(k1.close(), k2.close())
+"""
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from pymodaq_plugins_keithley.hardware.KeithleyWrapper import Keithley6487Wrapper, acquire_controller, \
+    release_controller
+
+EXECUTOR_MAX_WORKERS = 8
+_executor: ThreadPoolExecutor = None
+
+
+def get_executor() -> ThreadPoolExecutor:
+    """Thread pool shared by all the AsyncKeithley6487 instances, created on first use"""
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=EXECUTOR_MAX_WORKERS, thread_name_prefix='AsyncKeithley6487')
+    return _executor
+
+
+class AsyncKeithley6487:
+    """Awaitable methods running the ones of a Keithley6487Wrapper through its command queue
+
+    Parameters
+    ----------
+    controller: Keithley6487Wrapper
+    executor: ThreadPoolExecutor
+        thread pool running the blocking calls, by default the one shared by all instances
+    """
+
+    def __init__(self, controller: Keithley6487Wrapper, executor: ThreadPoolExecutor = None):
+        self.controller = controller
+        self.executor = executor if executor is not None else get_executor()
+        self._queue = asyncio.Lock()  # FIFO: commands are run in the order they were awaited
+
+    @classmethod
+    async def open(cls, visa_resource: str, timeout: int = 10000) -> 'AsyncKeithley6487':
+        """Acquire the shared controller of visa_resource (see acquire_controller) and configure it"""
+        loop = asyncio.get_running_loop()
+        controller = await loop.run_in_executor(get_executor(), acquire_controller, visa_resource, timeout)
+        instrument = cls(controller)
+        await instrument.setup()
+        return instrument
+
+    async def _run(self, function, *args, **kwargs):
+        async with self._queue:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, functools.partial(function, *args, **kwargs))
+
+    async def setup(self, force: bool = False):
+        await self._run(self.controller.setup, force)
+
+    async def get_device_infos(self) -> str:
+        return await self._run(self.controller.get_device_infos)
+
+    async def set_range(self, rangecurrent: str):
+        await self._run(self.controller.set_range, rangecurrent)
+
+    async def set_nplc(self, nplc: float):
+        await self._run(self.controller.set_nplc, nplc)
+
+    async def config_zerocheck(self, active: bool):
+        await self._run(self.controller.config_zerocheck, active)
+
+    async def set_source_range(self, range_s: int):
+        await self._run(self.controller.set_source_range, range_s)
+
+    async def set_source_voltage(self, volts: float):
+        await self._run(self.controller.set_source_voltage, volts)
+
+    async def operate_source(self, oper: bool):
+        await self._run(self.controller.operate_source, oper)
+
+    async def read(self, naverage: int = 1) -> list:
+        """[I, Vsource] averaged over naverage conversions, see Keithley6487Wrapper.read_average"""
+        return await self._run(self.controller.read_average, naverage)
+
+    async def read_buffer(self, npoints: int = 100) -> np.recarray:
+        return await self._run(self.controller.read_buffer, npoints)
+
+    async def fetch_buffer(self, npoints: int) -> np.recarray:
+        return await self._run(self.controller.fetch_buffer, npoints)
+
+    async def sweep(self, start: float, stop: float, step: float, delay: float = 0.0) -> np.recarray:
+        return await self._run(self.controller.sweep_voltage, start, stop, step, delay)
+
+    async def abort(self):
+        """Abort the running acquisition, bypassing the command queue
+
+        It runs in a thread of its own, the workers of the shared pool being possibly all busy waiting for
+        acquisitions.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def run():
+            try:
+                self.controller.abort()
+            except Exception as error:
+                loop.call_soon_threadsafe(future.set_exception, error)
+            else:
+                loop.call_soon_threadsafe(future.set_result, None)
+
+        threading.Thread(target=run, name='AsyncKeithley6487.abort', daemon=True).start()
+        await future
+
+    async def close(self):
+        await self._run(release_controller, self.controller)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
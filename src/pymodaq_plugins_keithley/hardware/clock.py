@@ -0,0 +1,102 @@
+"""Mapping of the Keithley 6487 reading timestamps to host time
+
+The instrument stamps each reading with its own timer, whose origin is unknown to the host and which drifts with
+respect to the host clock. Each time readings are received, the timestamp of the last one and the host time of
+reception give an upper bound of the offset between the two clocks, exceeded by the bus and processing latency. As in
+NTP, the smallest of these bounds are the best estimates: the offset and drift are taken from the minima over the two
+halves of a window of the last samples. Single readings (READ?/FETC?) give the tightest samples, buffered ones are
+received well after their last reading and are mostly filtered out.
+
+The drift is only estimated once the samples span MIN_DRIFT_BASELINE, and is bounded by MAX_DRIFT: over a short
+baseline the jitter of the latency would give a meaningless slope.
+"""
+import threading
+import time
+
+import numpy as np
+
+MIN_DRIFT_BASELINE = 10.0  # s of instrument time between the two halves of the window
+MAX_DRIFT = 1e-4  # 100 ppm, well above the tolerance of two quartz oscillators
+
+
+class ClockOffsetEstimator:
+    """Linear mapping of instrument timestamps to host time: instrument_time + offset + drift * (instrument_time - t0)
+
+    Parameters
+    ----------
+    size: int
+        number of (instrument, host) time samples kept
+    clock: callable
+        host clock, time.time by default so that the mapped times can be compared with the ones of other detectors
+    min_baseline: float
+        instrument time span in s below which the drift is taken as 0
+    max_drift: float
+        bound of the absolute value of the drift
+    """
+
+    def __init__(self, size: int = 200, clock=time.time, min_baseline: float = MIN_DRIFT_BASELINE,
+                 max_drift: float = MAX_DRIFT):
+        if size < 1:
+            raise ValueError(f"size {size} should be strictly positive")
+        self.size = size
+        self.clock = clock
+        self.min_baseline = min_baseline
+        self.max_drift = max_drift
+        self.offset: float = None
+        self.drift: float = 0.0
+        self.t0: float = 0.0
+        self._samples = np.zeros((size, 2))
+        self._count = 0
+        self._lock = threading.Lock()
+
+    @property
+    def ready(self) -> bool:
+        """True once at least one sample has been recorded"""
+        return self.offset is not None
+
+    def add(self, instrument_time: float, host_time: float = None):
+        """Record the reception at host_time (now if None) of a reading stamped instrument_time"""
+        host_time = self.clock() if host_time is None else host_time
+        with self._lock:
+            if self._count > 0 and instrument_time < self._samples[(self._count - 1) % self.size, 0]:
+                self._count = 0  # The instrument timer was reset, e.g. by *RST
+            self._samples[self._count % self.size] = (instrument_time, host_time)
+            self._count += 1
+            self._estimate()
+
+    def _estimate(self):
+        samples = self._samples[:min(self._count, self.size)]
+        samples = samples[np.argsort(samples[:, 0])]
+        delays = samples[:, 1] - samples[:, 0]
+        half = len(samples) // 2
+        first = int(np.argmin(delays[:half])) if half > 0 else 0
+        last = half + int(np.argmin(delays[half:]))
+        baseline = samples[last, 0] - samples[first, 0]
+        if baseline < self.min_baseline:  # No drift: the best offset is the smallest bound of all the samples
+            first = int(np.argmin(delays))
+        self.t0 = samples[first, 0]
+        self.offset = delays[first]
+        if baseline >= self.min_baseline:
+            self.drift = float(np.clip((delays[last] - delays[first]) / baseline, -self.max_drift, self.max_drift))
+        else:
+            self.drift = 0.0
+
+    def to_host(self, instrument_times) -> np.ndarray:
+        """Host times (s) of the readings stamped instrument_times"""
+        if not self.ready:
+            raise RuntimeError("No reading received yet, the instrument clock offset is unknown")
+        instrument_times = np.asarray(instrument_times, dtype=float)
+        return instrument_times + self.offset + self.drift * (instrument_times - self.t0)
+
+    def to_instrument(self, host_times) -> np.ndarray:
+        """Instrument times (s) at host_times, inverse of to_host"""
+        if not self.ready:
+            raise RuntimeError("No reading received yet, the instrument clock offset is unknown")
+        host_times = np.asarray(host_times, dtype=float)
+        return (host_times - self.offset + self.drift * self.t0) / (1 + self.drift)
+
+    def clear(self):
+        with self._lock:
+            self._count = 0
+            self.offset = None
+            self.drift = 0.0
@@ -0,0 +1,81 @@
+import time
+
+import numpy as np
+
+try:
+    import h5py
+except ImportError:  # h5py is an optional dependency, only needed for direct to disk acquisitions
+    h5py = None
+
+FIELDS = ['current', 'time', 'status', 'vsource']
+DTYPES = {'current': 'f4', 'time': 'f8', 'status': 'f4', 'vsource': 'f4'}  # float64 time, see TIMED_READING_DTYPE
+COMPRESSIONS = ['gzip', 'lzf', 'none']
+
+
+class ChunkedH5Writer:
+    """Append blocks of readings to chunked, extendable HDF5 datasets (one per reading field)
+
+    Only the current block is ever held in memory, the file being flushed at most every flush_interval seconds.
+
+    Parameters
+    ----------
+    path: str
+        HDF5 file, created if needed
+    group: str
+        group holding the current, time, status and vsource datasets, appended to if they already exist
+    chunk_size: int
+        number of readings per HDF5 chunk
+    compression: str
+        one of COMPRESSIONS
+    flush_interval: float
+        time in s between two flushes of the file
+    """
+
+    def __init__(self, path: str, group: str = 'keithley_6487', chunk_size: int = 10000, compression: str = 'gzip',
+                 flush_interval: float = 5.0):
+        if h5py is None:
+            raise ImportError("h5py is needed to write acquisitions to HDF5 files")
+        if compression not in COMPRESSIONS:
+            raise ValueError(f"{compression} not in {COMPRESSIONS}")
+
+        self.flush_interval = flush_interval
+        self.file = h5py.File(path, 'a')
+        h5group = self.file.require_group(group)
+        self.datasets = {}
+        for field in FIELDS:
+            if field in h5group:
+                self.datasets[field] = h5group[field]
+            else:
+                self.datasets[field] = h5group.create_dataset(
+                    field, shape=(0,), maxshape=(None,), chunks=(chunk_size,), dtype=DTYPES[field],
+                    compression=None if compression == 'none' else compression)
+        self.datasets['current'].attrs['units'] = 'A'
+        self.datasets['time'].attrs['units'] = 's'
+        self.datasets['vsource'].attrs['units'] = 'V'
+        self.last_flush = time.perf_counter()
+
+    def __len__(self):
+        return len(self.datasets['current'])
+
+    def append(self, readings: np.ndarray):
+        """Append a block of readings (a structured array with at least the FIELDS fields)"""
+        start = len(self)
+        for field in FIELDS:
+            dataset = self.datasets[field]
+            dataset.resize((start + len(readings),))
+            dataset[start:] = readings[field]
+        if time.perf_counter() - self.last_flush > self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        self.file.flush()
+        self.last_flush = time.perf_counter()
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
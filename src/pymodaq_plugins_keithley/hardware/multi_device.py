@@ -0,0 +1,71 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from pymodaq_plugins_keithley.hardware.KeithleyWrapper import Keithley6487Wrapper
+
+
+class Keithley6487Group:
+    """Several Keithley 6487 acquiring buffered readings together
+
+    Each instrument is triggered (a single bus write), waited for and fetched by its own thread of a pool, so that a
+    step lasts as long as the slowest instrument and not the sum of them. Each thread holds the lock of its controller
+    from the trigger to the fetch, so that no other plugin sharing it can send commands in between.
+
+    Parameters
+    ----------
+    controllers: list of Keithley6487Wrapper
+        typically obtained from acquire_controller, they are not closed by the group
+    """
+
+    def __init__(self, controllers: list):
+        self.controllers: list = controllers
+        self.trigger_times = np.zeros(len(controllers))
+        self._executor = ThreadPoolExecutor(max_workers=max(1, len(controllers)),
+                                            thread_name_prefix='Keithley6487Group')
+
+    def read_buffer(self, npoints: int = 100) -> list:
+        """Acquire npoints readings on every instrument
+
+        Returns
+        -------
+        list of np.recarray: the readings of each controller, see Keithley6487Wrapper.fetch_buffer (empty if aborted)
+        """
+        futures = [self._executor.submit(self._read_buffer, ind, npoints) for ind in range(len(self.controllers))]
+        return [future.result() for future in futures]
+
+    def _read_buffer(self, ind: int, npoints: int) -> np.recarray:
+        controller = self.controllers[ind]
+        # Taken in the pool thread that polls the status byte: held by the calling thread, the RLock would block it
+        with controller.exclusive():
+            controller.trigger_buffer(npoints)
+            self.trigger_times[ind] = time.perf_counter()
+            return controller.wait_and_fetch_buffer(npoints)
+
+    def read_aligned(self, npoints: int = 100) -> tuple:
+        """Acquire npoints readings on every instrument and resample them on a common time axis
+
+        Each instrument timestamps its readings with its own clock, so the times are taken relative to the first
+        reading, shifted by the delay between the triggers, and the currents are linearly interpolated on the time
+        axis of the first instrument.
+
+        Returns
+        -------
+        times: np.ndarray
+            common time axis in s, relative to the trigger of the first instrument
+        currents: np.ndarray
+            (number of instruments, npoints) array of currents in A
+        """
+        readings = self.read_buffer(npoints)
+        if any(len(reading) == 0 for reading in readings):  # Aborted
+            return np.zeros(0), np.zeros((len(readings), 0))
+        offsets = self.trigger_times - self.trigger_times[0]
+        times = [np.asarray(reading.time, dtype=float) - reading.time[0] + offset
+                 for reading, offset in zip(readings, offsets)]
+        currents = np.array([np.interp(times[0], instrument_times, np.asarray(reading.current, dtype=float))
+                             for instrument_times, reading in zip(times, readings)])
+        return times[0], currents
+
+    def close(self):
+        self._executor.shutdown(wait=False)
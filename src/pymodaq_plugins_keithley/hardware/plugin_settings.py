@@ -0,0 +1,100 @@
+"""Settings shared by the Keithley 6487 plugins: VISA resource selection and instrument configuration
+
+Only the parameter descriptions and the functions applying them to the settings tree or to the wrappers are here, the
+plugins add their own parameters around them. pymodaq is not imported, as in the rest of the hardware package.
+"""
+import copy
+
+from pymodaq_plugins_keithley.hardware.KeithleyWrapper import Keithley6487Wrapper, acquire_controller, \
+    list_visa_resources, CURRENT_RANGES, AVERAGE_MAX_COUNT
+
+DEFAULT_VISA = "GPIB0::22::INSTR"
+
+CONFIG_PARAMS = [
+    {'title': 'Range:', 'name': 'range', 'type': 'list', 'value': '20mA', 'default': '20mA', 'limits': list(CURRENT_RANGES)},
+    {'title': 'NPLC:', 'name': 'nplc', 'type': 'float', 'value': 5.0, 'default': 5.0, 'min': 0.01, 'max': 50},
+    {'title': 'Zerocheck', 'name': 'zerocheck', 'type': 'bool', 'value': True, 'default': True},
+    {'title': 'Source Range:', 'name': 'source_range', 'type': 'list', 'value': 10, 'limits': [10, 50, 500]},
+    {'title': 'Source Voltage (V):', 'name': 'source_voltage', 'type': 'float', 'value': 0.0, 'default': 0.0},
+    {'title': 'Operate Vsource', 'name': 'source_operate', 'type': 'bool', 'value': False, 'default': False},
+]
+
+# Wrapper method applying each configuration parameter, called with the parameter value
+CONFIG_SETTERS = {'range': Keithley6487Wrapper.set_range,
+                  'nplc': Keithley6487Wrapper.set_nplc,
+                  'zerocheck': Keithley6487Wrapper.config_zerocheck,
+                  'source_range': Keithley6487Wrapper.set_source_range,
+                  'source_voltage': Keithley6487Wrapper.set_source_voltage,
+                  'source_operate': Keithley6487Wrapper.operate_source}
+
+
+def visa_params(timeout: int = 10000) -> list:
+    """VISA resource, refresh button, instrument id and timeout parameters"""
+    return [
+        {'title': 'VISA:', 'name': 'visa', 'type': 'list', 'limits': []},
+        {'title': 'Refresh VISA list', 'name': 'refresh_visa', 'type': 'bool_push', 'value': False, 'label': 'Refresh'},
+        {'title': 'Id:', 'name': 'id', 'type': 'text', 'value': ""},
+        {'title': 'Timeout (ms):', 'name': 'timeout', 'type': 'int', 'value': timeout, 'default': timeout, 'min': 2000},
+    ]
+
+
+def config_params(*names: str) -> list:
+    """Configuration parameters (all of CONFIG_PARAMS if no name is given), to be used as children of a group"""
+    return [copy.deepcopy(param) for param in CONFIG_PARAMS if not names or param['name'] in names]
+
+
+def update_visa_list(param, refresh: bool = False):
+    """Fill the VISA list (or itemselect) parameter with the available resources, keeping the current selection
+
+    VISA buses are only enumerated when this is first called, from the plugin ini_attributes, not when the plugin
+    module is imported.
+    """
+    resources = list_visa_resources(refresh=refresh)
+    if param.type() == 'itemselect':
+        param.setValue(dict(all_items=resources, selected=param.value()['selected']))
+    else:
+        visa = param.value()
+        param.setLimits(resources)
+        param.setValue(visa)
+
+
+def ini_controller(settings):
+    """New controller for the VISA resource of settings, None if the plugin is a Slave sharing another one's"""
+    if settings.child('controller_status').value() == "Slave":
+        return None
+    return acquire_controller(visa_resource=settings.child('visa').value(), timeout=settings.child('timeout').value())
+
+
+def apply_config(controllers: list, name: str, value):
+    """Apply the value of the configuration parameter name (a key of CONFIG_SETTERS) to each controller"""
+    for controller in controllers:
+        CONFIG_SETTERS[name](controller, value)
+
+
+def set_filter_average(controller: Keithley6487Wrapper, naverage: int) -> str:
+    """Average naverage conversions in each reading with the instrument filter, at most AVERAGE_MAX_COUNT of them
+
+    For the acquisitions of one reading per trigger or of the trace buffer, unlike read_average which averages above
+    the filter capacity from the buffer.
+
+    Returns
+    -------
+    str: the message to report if naverage was capped, '' otherwise
+    """
+    count = min(naverage, AVERAGE_MAX_COUNT)
+    controller.set_average(count)
+    if count < naverage:
+        return f"Averaging {naverage} is above the instrument filter capacity: {count} conversions averaged per reading"
+    return ''
+
+
+def configure(controller: Keithley6487Wrapper, config):
+    """Setup the controller and apply the configuration parameters among the children of the group parameter config
+
+    All in a single bus transaction.
+    """
+    with controller.batch(opc=True):
+        controller.setup()
+        for param in config.children():
+            if param.name() in CONFIG_SETTERS:
+                apply_config([controller], param.name(), param.value())
@@ -0,0 +1,164 @@
+"""Timing of the VISA transactions of Keithley6487Wrapper
+
+Profiling is enabled by wrapping the pyvisa resource and the controller lock into ProfiledResource and ProfiledLock
+(see Keithley6487Wrapper.enable_profiling), so that nothing is measured nor stored when it is disabled. Timings go
+into the preallocated rings of a TransactionProfiler.
+"""
+import threading
+import time
+
+import numpy as np
+
+TRANSACTION_DTYPE = np.dtype([('timestamp', 'f8'),
+                              ('command', 'S24'),
+                              ('nbytes', 'i8'),
+                              ('write', 'f8'),
+                              ('read', 'f8')])
+
+
+class TransactionProfiler:
+    """Fixed size rings of the last transactions timings and lock waiting times (all durations in s)"""
+
+    def __init__(self, size: int = 10000):
+        self.size = size
+        self.transactions = np.zeros(size, dtype=TRANSACTION_DTYPE)
+        self.lock_waits = np.zeros(size)
+        self.ntransactions = 0
+        self.nlock_waits = 0
+
+    def record(self, command, nbytes: int, write: float = 0.0, read: float = 0.0):
+        """Store a transaction: command is its SCPI message (truncated) or a description such as 'read'"""
+        self.transactions[self.ntransactions % self.size] = (time.perf_counter(), command[:24], nbytes, write, read)
+        self.ntransactions += 1
+
+    def record_lock_wait(self, duration: float):
+        self.lock_waits[self.nlock_waits % self.size] = duration
+        self.nlock_waits += 1
+
+    def clear(self):
+        self.ntransactions = 0
+        self.nlock_waits = 0
+
+    def summary(self) -> dict:
+        """Number of samples, p50 and p99 (in s) of the write, read and lock waiting times
+
+        Returns
+        -------
+        dict: {'write': (n, p50, p99), 'read': ..., 'lock_wait': ..., 'commands': {command header: (n, p50, p99)}},
+        the per command statistics being computed on the total (write + read) transaction time, the writes of
+        several joined commands being counted under 'batch' and the responses under the query they answer
+        """
+        transactions = self.transactions[:min(self.ntransactions, self.size)]
+        lock_waits = self.lock_waits[:min(self.nlock_waits, self.size)]
+        summary = {'write': _stats(transactions['write'][transactions['write'] > 0]),
+                   'read': _stats(transactions['read'][transactions['read'] > 0]),
+                   'lock_wait': _stats(lock_waits),
+                   'commands': {}}
+        headers = np.array([command.split(b' ')[0].decode(errors='replace') for command in transactions['command']])
+        for header in np.unique(headers):
+            durations = transactions['write'][headers == header] + transactions['read'][headers == header]
+            summary['commands'][str(header)] = _stats(durations)
+        return summary
+
+    def status(self) -> str:
+        """One line p50/p99 summary in ms, to be displayed in a status bar"""
+        summary = self.summary()
+        return ', '.join(f"{key} p50 {summary[key][1] * 1e3:.2f} ms p99 {summary[key][2] * 1e3:.2f} ms"
+                         for key in ['write', 'read', 'lock_wait'])
+
+
+def _stats(durations: np.ndarray) -> tuple:
+    if len(durations) == 0:
+        return 0, 0.0, 0.0
+    p50, p99 = np.percentile(durations, [50, 99])
+    return len(durations), float(p50), float(p99)
+
+
+def _write_label(message: str) -> bytes:
+    """Command under which a write is recorded: the message itself, or 'batch' for several joined commands"""
+    return b'batch' if ';' in message else message.strip().lstrip(':').encode()
+
+
+def _read_label(message: str) -> bytes:
+    """Command under which the response to message is recorded: its last command, the only query of a batch"""
+    return message.split(';')[-1].strip().lstrip(':').encode()
+
+
+class ProfiledResource:
+    """Proxy of a pyvisa resource recording the duration of each write and read"""
+
+    def __init__(self, resource, profiler: TransactionProfiler):
+        object.__setattr__(self, 'resource', resource)
+        object.__setattr__(self, 'profiler', profiler)
+        object.__setattr__(self, 'last_command', b'')
+
+    def __getattr__(self, item):
+        return getattr(self.resource, item)
+
+    def __setattr__(self, key, value):
+        setattr(self.resource, key, value)
+
+    def write(self, message: str):
+        start = time.perf_counter()
+        ret = self.resource.write(message)
+        self.profiler.record(_write_label(message), len(message), write=time.perf_counter() - start)
+        object.__setattr__(self, 'last_command', _read_label(message))
+        return ret
+
+    def read_raw(self, *args, **kwargs) -> bytes:
+        start = time.perf_counter()
+        vals = self.resource.read_raw(*args, **kwargs)
+        self.profiler.record(self.last_command, len(vals), read=time.perf_counter() - start)
+        return vals
+
+    def read_bytes(self, *args, **kwargs) -> bytes:
+        start = time.perf_counter()
+        vals = self.resource.read_bytes(*args, **kwargs)
+        self.profiler.record(self.last_command, len(vals), read=time.perf_counter() - start)
+        return vals
+
+    def read(self, *args, **kwargs) -> str:
+        start = time.perf_counter()
+        vals = self.resource.read(*args, **kwargs)
+        self.profiler.record(self.last_command, len(vals), read=time.perf_counter() - start)
+        return vals
+
+    def query(self, message: str, *args, **kwargs) -> str:
+        start = time.perf_counter()
+        self.resource.write(message)
+        written = time.perf_counter()
+        vals = self.resource.read(*args, **kwargs)
+        self.profiler.record(_write_label(message), 0, write=written - start)
+        self.profiler.record(_read_label(message), len(vals), read=time.perf_counter() - written)
+        return vals
+
+    def read_stb(self) -> int:
+        start = time.perf_counter()
+        stb = self.resource.read_stb()
+        self.profiler.record(b'*STB (serial poll)', 1, read=time.perf_counter() - start)
+        return stb
+
+
+class ProfiledLock:
+    """Context manager around a (R)Lock recording the time spent waiting for it"""
+
+    def __init__(self, lock: threading.RLock, profiler: TransactionProfiler):
+        self.lock = lock
+        self.profiler = profiler
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.lock.release()
+
+    def acquire(self, *args, **kwargs) -> bool:
+        start = time.perf_counter()
+        acquired = self.lock.acquire(*args, **kwargs)
+        if acquired:
+            self.profiler.record_lock_wait(time.perf_counter() - start)
+        return acquired
+
+    def release(self):
+        self.lock.release()
@@ -0,0 +1,66 @@
+import threading
+
+import numpy as np
+
+
+class RingBuffer:
+    """Fixed size preallocated circular buffer, thread safe for one producer and several readers
+
+    Readers keep track of the total number of values they have consumed (see read_since), values older than the
+    capacity are silently overwritten so that memory use is bounded whatever the run length.
+    """
+
+    def __init__(self, capacity: int, dtype):
+        if capacity < 1:
+            raise ValueError(f"capacity {capacity} should be strictly positive")
+        self.capacity = capacity
+        self._data = np.zeros(capacity, dtype=dtype)
+        self._count = 0
+        self._lock = threading.Lock()
+
+    @property
+    def count(self) -> int:
+        """Total number of values written since creation"""
+        return self._count
+
+    def __len__(self):
+        return min(self._count, self.capacity)
+
+    def extend(self, values: np.ndarray):
+        """Append values, overwriting the oldest ones once full"""
+        nvalues = len(values)
+        values = values[-self.capacity:]
+        with self._lock:
+            start = (self._count + nvalues - len(values)) % self.capacity
+            first = min(len(values), self.capacity - start)
+            self._data[start:start + first] = values[:first]
+            self._data[:len(values) - first] = values[first:]
+            self._count += nvalues
+
+    def read_since(self, index: int) -> tuple:
+        """Copy of the values written since the total count index (at most capacity of them)
+
+        Returns
+        -------
+        values: np.ndarray
+        count: int
+            total count to pass as index for the next call
+        """
+        with self._lock:
+            count = self._count
+            start = max(index, count - self.capacity)
+            npoints = count - start
+            first = start % self.capacity
+            if first + npoints <= self.capacity:
+                values = self._data[first:first + npoints].copy()
+            else:
+                values = np.concatenate((self._data[first:], self._data[:first + npoints - self.capacity]))
+        return values, count
+
+    def latest(self, npoints: int) -> np.ndarray:
+        """Copy of the npoints most recent values"""
+        return self.read_since(self._count - npoints)[0]
+
+    def clear(self):
+        with self._lock:
+            self._count = 0
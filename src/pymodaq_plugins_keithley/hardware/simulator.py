@@ -0,0 +1,294 @@
+"""Pure python stand-in for a Keithley 6487 behind pyvisa
+
+Simulated6487Resource understands the SCPI commands sent by Keithley6487Wrapper and answers with correctly framed
+REAL,32 readings. Each command costs a configurable bus latency and each reading an integration time derived from
+NPLC, so that throughput measurements made against it are meaningful. The current is the one flowing through a
+resistor biased by the voltage source, plus some noise decreasing with the integration time.
+
+Use it through acquire_controller with a visa address starting with SIMULATED_PREFIX, or directly by passing a
+SimulatedResourceManager to Keithley6487Wrapper.
+"""
+import re
+import threading
+import time
+
+import numpy as np
+from pyvisa import constants, errors
+
+from pymodaq_plugins_keithley.hardware.KeithleyWrapper import READING_DTYPE, TIMED_READING_DTYPE, BUFFER_MAX_POINTS, \
+    STATUS_OVERFLOW
+
+SIMULATED_PREFIX = 'SIM::'
+SIMULATED_RESOURCE = 'SIM::6487::INSTR'
+
+OVERFLOW_READING = 9.9e37
+
+
+def short_form(header: str) -> str:
+    """Short form of a SCPI header, e.g. SOURce:VOLTage:STATe -> SOUR:VOLT:STAT"""
+    header = header.upper()
+    query = '?' if header.endswith('?') else ''
+    if header.startswith('*'):
+        return header
+    nodes = []
+    for node in header.rstrip('?').strip(':').split(':'):
+        if len(node) > 4:
+            node = node[:3] if node[3] in 'AEIOU' else node[:4]
+        nodes.append(node)
+    return ':'.join(nodes) + query
+
+
+class Simulated6487Resource:
+    """Mimics the subset of pyvisa MessageBasedResource used by Keithley6487Wrapper
+
+    Parameters
+    ----------
+    latency: float
+        time in s taken by each command (bus addressing and transfer overhead)
+    line_frequency: float
+        power line frequency in Hz setting the integration time of 1 NPLC
+    resistance: float
+        resistance in Ohm of the simulated device under test
+    noise: float
+        current noise standard deviation in A for a 1 NPLC integration
+    """
+
+    def __init__(self, latency: float = 1e-3, line_frequency: float = 50.0, resistance: float = 1e6,
+                 noise: float = 1e-12):
+        self.latency = latency
+        self.line_frequency = line_frequency
+        self.resistance = resistance
+        self.noise = noise
+
+        self.timeout = 1000
+        self.write_termination = '\n'
+        self.read_termination = '\n'
+        self.errors = []  # Commands the instrument would have rejected
+
+        self._output = bytearray()
+        self._lock = threading.Lock()
+        self._rng = np.random.default_rng()
+        self._t0 = time.perf_counter()
+        self.reset()
+
+    def reset(self):
+        self.state = {'nplc': 5.0, 'range': 2e-2, 'zerocheck': True, 'average': False, 'average_count': 10,
+                      'source_voltage': 0.0, 'source_range': 10, 'source_operate': False, 'format': 'ASC',
+                      'trace_points': 100, 'trace_feed_control': 'NEV', 'arm_count': 1, 'trigger_count': 1,
+                      'sweep_start': 0.0, 'sweep_stop': 10.0, 'sweep_step': 1.0, 'sweep_delay': 0.0,
+                      'sweep_armed': False, 'event_enable': 0, 'timestamp_format': 'ABS'}
+        self.event_register = 0
+        self.opc_pending = False
+        self.trace = np.zeros(0, dtype=TIMED_READING_DTYPE)
+        self.readings = np.zeros(0, dtype=TIMED_READING_DTYPE)
+        self.done_time = 0.0
+
+    @property
+    def integration_time(self) -> float:
+        """Time in s taken by one reading"""
+        count = self.state['average_count'] if self.state['average'] else 1
+        return self.state['nplc'] / self.line_frequency * count
+
+    def _initiate(self):
+        """Run the trigger model: the readings are computed now but only available at done_time"""
+        npoints = self.state['arm_count'] * self.state['trigger_count']
+        now = time.perf_counter()
+        duration = npoints * self.integration_time
+        if self.state['sweep_armed']:
+            step = abs(self.state['sweep_step']) * np.sign(self.state['sweep_stop'] - self.state['sweep_start'])
+            volts = self.state['sweep_start'] + step * np.arange(npoints)
+            duration += npoints * self.state['sweep_delay']
+            self.state['sweep_armed'] = False
+            self.state['source_operate'] = True
+            self.state['source_voltage'] = volts[-1]
+        else:
+            volts = np.full(npoints, self.state['source_voltage'] if self.state['source_operate'] else 0.0)
+
+        readings = np.zeros(npoints, dtype=TIMED_READING_DTYPE)
+        noise = self.noise / np.sqrt(self.integration_time * self.line_frequency)
+        current = volts / self.resistance + self._rng.normal(0, noise, npoints)
+        if self.state['zerocheck']:
+            current = self._rng.normal(0, noise, npoints)
+        overflow = np.abs(current) > 1.05 * self.state['range']
+        readings['current'] = np.where(overflow, OVERFLOW_READING, current)
+        readings['unit'] = b'A'
+        readings['time'] = now - self._t0 + self.integration_time * np.arange(1, npoints + 1)
+        readings['status'] = np.where(overflow, STATUS_OVERFLOW, 0)
+        readings['vsource'] = volts
+        self.readings = readings
+        self.done_time = now + duration
+
+        if self.state['trace_feed_control'] == 'NEXT':
+            self.trace = np.concatenate((self.trace, readings))[:self.state['trace_points']]
+            if len(self.trace) >= self.state['trace_points']:
+                self.state['trace_feed_control'] = 'NEV'
+
+    def _wait_done(self):
+        remaining = self.done_time - time.perf_counter()
+        if remaining > self.timeout / 1000:
+            time.sleep(self.timeout / 1000)
+            raise errors.VisaIOError(constants.StatusCode.error_timeout)
+        if remaining > 0:
+            time.sleep(remaining)
+
+    def _respond(self, response):
+        if isinstance(response, np.ndarray):
+            if self.state['format'] != 'REAL':
+                raise ValueError("Only the REAL data format is simulated")  # Recorded in errors by _execute
+            self._output += b'#0' + response.astype(READING_DTYPE).tobytes() + self.read_termination.encode()
+        else:
+            self._output += (str(response) + self.read_termination).encode()
+
+    def _execute(self, command: str):
+        match = re.match(r'\s*(\*?[A-Za-z:]+\??)\s*(.*)$', command)
+        if match is None or match.group(1).endswith(':'):
+            self.errors.append(command)
+            return
+        header = short_form(match.group(1))
+        arg = match.group(2).strip()
+        state = self.state
+
+        try:
+            if header == '*RST':
+                self.reset()
+            elif header in ('*CLS', 'STAT:PRES'):
+                self.event_register = 0
+            elif header == '*IDN?':
+                self._respond('KEITHLEY INSTRUMENTS INC.,MODEL 6487,0000000,A00 (simulated)')
+            elif header == '*ESE':
+                state['event_enable'] = int(arg)
+            elif header == '*ESR?':
+                self._respond(self.event_register)
+                self.event_register = 0
+            elif header == '*OPC':
+                self.opc_pending = True
+            elif header == '*OPC?':
+                self._wait_done()
+                self._respond(1)
+            elif header.startswith('CONF'):
+                state['mode'] = header.split(':')[1] if ':' in header else 'CURR'
+            elif header == 'FORM:DATA':
+                state['format'] = short_form(arg.split(',')[0])
+            elif header == 'FORM:ELEM':
+                state['elements'] = arg
+            elif header in ('CURR:NPLC', 'SENS:CURR:NPLC', 'NPLC'):
+                state['nplc'] = float(arg)
+            elif header in ('CURR:RANG', 'SENS:CURR:RANG'):
+                state['range'] = float(arg)
+            elif header == 'SYST:ZCH':
+                state['zerocheck'] = arg.upper() in ('ON', '1')
+            elif header in ('AVER', 'AVER:STAT'):
+                state['average'] = arg.upper() in ('ON', '1')
+            elif header == 'AVER:COUN':
+                state['average_count'] = int(arg)
+            elif header == 'AVER:TCON':
+                state['average_control'] = short_form(arg)
+            elif header == 'SOUR:VOLT':
+                state['source_voltage'] = float(arg)
+            elif header == 'SOUR:VOLT:RANG':
+                state['source_range'] = int(float(arg))
+            elif header == 'SOUR:VOLT:STAT':
+                state['source_operate'] = arg.upper() in ('ON', '1')
+            elif header in ('SOUR:VOLT:SWE:STAR', 'SOUR:VOLT:SWE:STOP', 'SOUR:VOLT:SWE:STEP', 'SOUR:VOLT:SWE:DEL'):
+                state[{'STAR': 'sweep_start', 'STOP': 'sweep_stop', 'STEP': 'sweep_step',
+                       'DEL': 'sweep_delay'}[header.split(':')[-1]]] = float(arg)
+            elif header == 'SOUR:VOLT:SWE:INIT':
+                state['sweep_armed'] = True
+            elif header == 'TRAC:CLE':
+                self.trace = np.zeros(0, dtype=TIMED_READING_DTYPE)
+            elif header == 'TRAC:POIN':
+                state['trace_points'] = min(int(arg), BUFFER_MAX_POINTS)
+            elif header == 'TRAC:FEED':
+                state['trace_feed'] = short_form(arg)
+            elif header == 'TRAC:FEED:CONT':
+                state['trace_feed_control'] = short_form(arg)
+            elif header == 'TRAC:TST:FORM':
+                if short_form(arg) not in ('ABS', 'DELT'):
+                    raise ValueError(arg)
+                state['timestamp_format'] = short_form(arg)
+            elif header == 'ARM:COUN':
+                state['arm_count'] = int(arg)
+            elif header == 'TRIG:COUN':
+                state['trigger_count'] = int(arg)
+            elif header == 'INIT':
+                self._initiate()
+            elif header in ('INIT:ABOR', 'ABOR'):
+                self.done_time = time.perf_counter()
+            elif header == 'READ?':
+                self._initiate()
+                self._wait_done()
+                self._respond(self.readings)
+            elif header == 'FETC?':
+                self._wait_done()
+                self._respond(self.readings)
+            elif header == 'TRAC:DATA?':
+                # Buffered timestamps are relative to the first reading (ABSolute) or to the previous one (DELTa)
+                trace = self.trace.copy()
+                if len(trace) > 0:
+                    trace['time'] = np.diff(trace['time'], prepend=trace['time'][0]) \
+                        if state['timestamp_format'] == 'DELT' else trace['time'] - trace['time'][0]
+                self._respond(trace)
+            else:
+                self.errors.append(command)
+        except ValueError:
+            self.errors.append(command)
+
+    def write(self, message: str):
+        time.sleep(self.latency)
+        with self._lock:
+            for command in message.split(';'):
+                if command.strip():
+                    self._execute(command)
+        return len(message)
+
+    def read_raw(self, size: int = None) -> bytes:
+        time.sleep(self.latency)
+        with self._lock:
+            if not self._output:
+                raise errors.VisaIOError(constants.StatusCode.error_timeout)
+            size = len(self._output) if size is None else size
+            data = bytes(self._output[:size])
+            del self._output[:size]
+        return data
+
+    def read_bytes(self, count: int, chunk_size: int = None, break_on_termchar: bool = False) -> bytes:
+        data = self.read_raw(count)
+        if len(data) < count:
+            raise errors.VisaIOError(constants.StatusCode.error_timeout)
+        return data
+
+    def read(self) -> str:
+        return self.read_raw().decode().rstrip(self.read_termination)
+
+    def query(self, message: str) -> str:
+        self.write(message)
+        return self.read()
+
+    def read_stb(self) -> int:
+        time.sleep(self.latency)
+        with self._lock:
+            if self.opc_pending and time.perf_counter() >= self.done_time:
+                self.opc_pending = False
+                self.event_register |= 1
+            return 0x20 if self.event_register & self.state['event_enable'] else 0
+
+    def clear(self):
+        time.sleep(self.latency)
+        with self._lock:
+            self._output.clear()
+
+    def close(self):
+        pass
+
+
+class SimulatedResourceManager:
+    """ResourceManager look alike opening Simulated6487Resource instances"""
+
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+
+    def list_resources(self) -> tuple:
+        return SIMULATED_RESOURCE,
+
+    def open_resource(self, resource_name: str, **kwargs) -> Simulated6487Resource:
+        return Simulated6487Resource(**self.kwargs)
@@ -0,0 +1,31 @@
+import numpy as np
+
+from pymodaq_plugins_keithley.hardware.clock import ClockOffsetEstimator, MAX_DRIFT
+
+
+def test_no_drift_over_a_short_baseline():
+    clock = ClockOffsetEstimator()
+    for ind, latency in enumerate([0.002, 0.0005, 0.004]):
+        clock.add(ind * 0.1, 1000 + ind * 0.1 + latency)
+    assert clock.drift == 0.0
+    assert clock.offset == 1000.0005
+
+
+def test_drift_is_estimated_and_bounded():
+    rng = np.random.default_rng(0)
+    clock = ClockOffsetEstimator()
+    for ind in range(200):
+        clock.add(ind * 0.5, 1000 + ind * 0.5 * (1 + 20e-6) + rng.exponential(1e-3))
+    assert abs(clock.drift - 20e-6) < 5e-6
+
+    clock = ClockOffsetEstimator()
+    for ind in range(200):
+        clock.add(ind * 0.5, 1000 + ind * 0.5 * 1.01)
+    assert clock.drift == MAX_DRIFT
+
+
+def test_to_instrument_is_the_inverse_of_to_host():
+    clock = ClockOffsetEstimator()
+    for ind in range(200):
+        clock.add(ind * 0.5, 1000 + ind * 0.5 * (1 + 50e-6))
+    assert np.isclose(clock.to_host(clock.to_instrument(1050.0)), 1050.0)
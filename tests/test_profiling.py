@@ -0,0 +1,42 @@
+import threading
+
+from pymodaq_plugins_keithley.hardware.profiling import TransactionProfiler, ProfiledResource, ProfiledLock
+
+
+class EchoResource:
+    def write(self, message):
+        self.message = message
+
+    def read(self):
+        return '1'
+
+
+def test_batched_writes_and_their_response_are_recorded_apart():
+    profiler = TransactionProfiler(100)
+    resource = ProfiledResource(EchoResource(), profiler)
+    resource.write(':TRAC:CLE;:TRAC:POIN 10;:TRIG:COUN 1;:READ?')
+    resource.read()
+    resource.write('*IDN?')
+    resource.read()
+    commands = profiler.summary()['commands']
+    assert set(commands) == {'batch', 'READ?', '*IDN?'}
+    assert commands['batch'][0] == 1
+    assert commands['READ?'][0] == 1
+    assert commands['*IDN?'][0] == 2
+
+
+def test_query_response_is_recorded_under_the_query():
+    profiler = TransactionProfiler(100)
+    resource = ProfiledResource(EchoResource(), profiler)
+    resource.query(':ARM:COUN 1;:FETC?')
+    assert set(profiler.summary()['commands']) == {'batch', 'FETC?'}
+
+
+def test_lock_waits_are_recorded_by_acquire_and_the_context_manager():
+    profiler = TransactionProfiler(100)
+    lock = ProfiledLock(threading.RLock(), profiler)
+    with lock:
+        pass
+    assert lock.acquire()
+    lock.release()
+    assert profiler.nlock_waits == 2
@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+
+from pymodaq_plugins_keithley.hardware.ring_buffer import RingBuffer
+
+
+def test_wrap_around():
+    ring = RingBuffer(5, float)
+    ring.extend(np.arange(3))
+    ring.extend(np.arange(3, 7))
+    assert ring.count == 7
+    assert len(ring) == 5
+    assert np.array_equal(ring.latest(5), np.arange(2, 7))
+    assert np.array_equal(ring.latest(2), [5, 6])
+
+
+def test_read_since():
+    ring = RingBuffer(5, float)
+    ring.extend(np.arange(4))
+    values, count = ring.read_since(0)
+    assert np.array_equal(values, np.arange(4))
+    ring.extend(np.arange(4, 8))
+    values, count = ring.read_since(count)
+    assert np.array_equal(values, np.arange(4, 8))
+    assert count == 8
+    values, count = ring.read_since(0)  # the oldest values were overwritten
+    assert np.array_equal(values, np.arange(3, 8))
+
+
+def test_extend_larger_than_capacity():
+    ring = RingBuffer(5, float)
+    ring.extend(np.arange(2))
+    ring.extend(np.arange(2, 14))
+    assert ring.count == 14
+    assert np.array_equal(ring.latest(5), np.arange(9, 14))
+
+
+def test_capacity():
+    with pytest.raises(ValueError):
+        RingBuffer(0, float)
@@ -0,0 +1,75 @@
+"""The VISA buses must not be enumerated when the plugins are imported, only when listed (and then cached)"""
+import importlib
+import sys
+from unittest import mock
+
+import pytest
+
+from pymodaq_plugins_keithley.hardware import KeithleyWrapper
+
+PLUGIN_MODULES = [
+    'pymodaq_plugins_keithley.daq_viewer_plugins.plugins_0D.daq_0Dviewer_Keithley_6487',
+    'pymodaq_plugins_keithley.daq_move_plugins.daq_move_Keithley_6487',
+    'pymodaq_plugins_keithley.daq_viewer_plugins.plugins_1D.daq_1Dviewer_Keithley_6487',
+    'pymodaq_plugins_keithley.daq_viewer_plugins.plugins_1D.daq_1Dviewer_Keithley_6487_Multi',
+    'pymodaq_plugins_keithley.daq_viewer_plugins.plugins_1D.daq_1Dviewer_Keithley_6487_Sweep',
+]
+
+
+@pytest.fixture
+def visa_backend(monkeypatch):
+    """Mock pyvisa ResourceManager factory and the resource manager it returns, with an empty registry cache"""
+    resource_manager = mock.MagicMock()
+    resource_manager.list_resources.return_value = ('GPIB0::22::INSTR',)
+    factory = mock.MagicMock(return_value=resource_manager)
+    monkeypatch.setattr('pyvisa.ResourceManager', factory)
+    monkeypatch.setattr(KeithleyWrapper, 'ResourceManager', factory)
+    monkeypatch.setattr(KeithleyWrapper, '_resource_manager', None)
+    monkeypatch.setattr(KeithleyWrapper, '_visa_resources', None)
+    return factory, resource_manager
+
+
+@pytest.mark.parametrize('module', PLUGIN_MODULES)
+def test_plugin_import_does_not_enumerate(visa_backend, module):
+    pytest.importorskip('pymodaq')
+    factory, resource_manager = visa_backend
+    sys.modules.pop(module, None)
+    importlib.import_module(module)
+    assert factory.call_count == 0
+    assert resource_manager.list_resources.call_count == 0
+
+
+def test_list_visa_resources_is_cached(visa_backend):
+    factory, resource_manager = visa_backend
+    assert 'GPIB0::22::INSTR' in KeithleyWrapper.list_visa_resources()
+    KeithleyWrapper.list_visa_resources()
+    assert factory.call_count == 1
+    assert resource_manager.list_resources.call_count == 1
+
+
+def test_list_visa_resources_refresh(visa_backend):
+    factory, resource_manager = visa_backend
+    KeithleyWrapper.list_visa_resources()
+    KeithleyWrapper.list_visa_resources(refresh=True)
+    assert resource_manager.list_resources.call_count == 2
+
+
+def test_list_visa_resources_ttl(visa_backend, monkeypatch):
+    factory, resource_manager = visa_backend
+    now = [1000.0]
+    monkeypatch.setattr(KeithleyWrapper.time, 'monotonic', lambda: now[0])
+    KeithleyWrapper.list_visa_resources(ttl=60)
+    now[0] += 30
+    KeithleyWrapper.list_visa_resources(ttl=60)
+    assert resource_manager.list_resources.call_count == 1
+    now[0] += 31
+    KeithleyWrapper.list_visa_resources(ttl=60)
+    assert resource_manager.list_resources.call_count == 2
+
+
+def test_simulated_resource_only_listed_on_request(visa_backend, monkeypatch):
+    monkeypatch.delenv(KeithleyWrapper.SIMULATOR_ENV, raising=False)
+    assert 'SIM::6487::INSTR' not in KeithleyWrapper.list_visa_resources()
+    assert 'SIM::6487::INSTR' in KeithleyWrapper.list_visa_resources(include_simulated=True)
+    monkeypatch.setenv(KeithleyWrapper.SIMULATOR_ENV, '1')
+    assert 'SIM::6487::INSTR' in KeithleyWrapper.list_visa_resources()
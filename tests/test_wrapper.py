@@ -0,0 +1,216 @@
+import threading
+import time
+
+import numpy as np
+import pytest
+from pyvisa import constants, errors
+
+from pymodaq_plugins_keithley.hardware.KeithleyWrapper import Keithley6487Wrapper, AutoRanger, AdaptiveNPLC, \
+    decode_readings, READING_DTYPE, READING_SIZE, BATCH_MAX_LENGTH, STATUS_OVERFLOW
+from pymodaq_plugins_keithley.hardware.simulator import SimulatedResourceManager, SIMULATED_RESOURCE
+
+
+@pytest.fixture
+def controller():
+    controller = Keithley6487Wrapper(SIMULATED_RESOURCE, timeout=2000, visa_rm=SimulatedResourceManager(latency=0.0))
+    controller.setup()
+    controller.config_zerocheck(False)
+    controller.set_nplc(0.01)
+    yield controller
+    controller.close()
+
+
+@pytest.fixture
+def sent(controller):
+    """Messages written to the simulated resource"""
+    messages = []
+    write = controller.resource.write
+
+    def spy(message):
+        messages.append(message)
+        return write(message)
+
+    controller.resource.write = spy
+    return messages
+
+
+def make_readings(npoints: int) -> np.ndarray:
+    readings = np.zeros(npoints, dtype=READING_DTYPE)
+    readings['current'] = np.arange(npoints) * 1e-9
+    readings['unit'] = b'A'
+    readings['time'] = np.arange(npoints) * 0.01
+    return readings
+
+
+class BlockResource:
+    """Resource returning a fixed response, timing out as pyvisa if asked for more"""
+
+    read_termination = '\n'
+
+    def __init__(self, response: bytes):
+        self.response = bytearray(response)
+
+    def read_bytes(self, count: int, **kwargs) -> bytes:
+        if count > len(self.response):
+            raise errors.VisaIOError(constants.StatusCode.error_timeout)
+        data = bytes(self.response[:count])
+        del self.response[:count]
+        return data
+
+    def clear(self):
+        self.response.clear()
+
+    def close(self):
+        pass
+
+
+def test_decode_readings_indefinite_and_definite_length():
+    readings = make_readings(3)
+    payload = readings.tobytes()
+    for block in [b'#0' + payload + b'\n', f'#2{len(payload)}'.encode() + payload]:
+        decoded = decode_readings(block)
+        assert len(decoded) == 3
+        assert np.array_equal(decoded.current, readings['current'])
+        assert len(decode_readings(block, 2)) == 2
+        with pytest.raises(ValueError):
+            decode_readings(block, 4)
+    with pytest.raises(ValueError):
+        decode_readings(b'X0' + payload)
+
+
+def test_read_block(controller):
+    payload = make_readings(3).tobytes()
+    controller.resource = BlockResource(b'#0' + payload + b'\n')
+    assert np.array_equal(decode_readings(controller.read_block(3), 3).time, make_readings(3)['time'])
+    controller.resource = BlockResource(f'#2{len(payload)}'.encode() + payload + b'\n')
+    assert len(decode_readings(controller.read_block(3), 3)) == 3
+
+
+def test_read_block_bad_framing(controller):
+    payload = make_readings(3).tobytes()
+    controller.resource = BlockResource(b'#0' + payload + b'\n')
+    with pytest.raises(ValueError):
+        controller.read_block(2)  # not followed by the termination
+    controller.resource = BlockResource(f'#2{len(payload)}'.encode() + payload + b'\n')
+    with pytest.raises(ValueError):
+        controller.read_block(2)  # header length mismatch
+    controller.resource = BlockResource(b'+1.000000E-09A,+1.000000E+00,+0.000000E+00\n')
+    with pytest.raises(ValueError):
+        controller.read_block(1)  # ASCII response
+
+
+def test_next_read_after_bad_framing(controller):
+    controller.resource.write(":TRIG:COUN 3;:READ?")
+    with pytest.raises(ValueError):
+        controller.read_block(2)  # 3 readings received
+    assert controller.resource.query("*IDN?").startswith('KEITHLEY')
+
+
+def test_write_setting_skips_known_values(controller, sent):
+    controller.set_nplc(1.0)
+    controller.set_nplc(1.0)
+    assert sent == ['CURR:NPLC 1.0']
+    controller.invalidate('nplc')
+    controller.set_nplc(1.0)
+    assert len(sent) == 2
+    controller.invalidate()
+    controller.set_nplc(1.0)
+    controller.config_zerocheck(False)
+    assert len(sent) == 4
+    assert controller.get_setting('nplc') == 1.0
+
+
+def test_batch_split_at_max_length(controller, sent):
+    commands = [f"SOUR:VOLT:SWE:STAR {ind / 1000:.3f}" for ind in range(40)]
+    with controller.batch():
+        for command in commands:
+            controller.write(command)
+        assert sent == []
+    assert len(sent) > 1
+    assert all(len(message) <= BATCH_MAX_LENGTH for message in sent)
+    assert ';'.join(sent).split(';') == [':' + command for command in commands]
+    assert controller.resource.errors == []
+
+
+def test_batch_flushed_by_query(controller, sent):
+    with controller.batch():
+        controller.write("SYST:ZCH OFF")
+        assert controller.query("*IDN?").startswith('KEITHLEY')
+        assert sent == [':SYST:ZCH OFF;*IDN?']
+        controller.write("SYST:ZCH ON")
+    assert sent[-1] == ':SYST:ZCH ON'
+
+
+def test_read_buffer(controller):
+    readings = controller.read_buffer(100)
+    assert len(readings) == 100
+    assert np.all(np.diff(readings.time) > 0)
+    assert controller.time == pytest.approx(float(readings.time[-1]))
+    assert controller.resource.errors == []
+
+
+def test_buffered_timestamps_follow_the_instrument_timer(controller):
+    controller.resource._t0 -= 72000.0  # Instrument timer started 20 h before the host opened it
+    readings = controller.read_buffer(100)  # No reading received before: origin from FETC?
+    assert readings.time[0] == pytest.approx(72000.0, abs=1.0)
+    assert np.all(np.diff(readings.time) > 0)  # not rounded to the 7.8 ms float32 resolution
+    controller.read_current_and_vsource()
+    assert 0 < controller.time - readings.time[-1] < 1.0
+    single = controller.time
+    readings = controller.read_buffer(100)  # origin from the clock offset
+    assert 0 < readings.time[0] - single < 1.0
+    assert readings.time.dtype == np.float64
+
+
+def test_abort(controller):
+    controller.set_nplc(1.0)  # 2 s for 100 readings
+    threading.Timer(0.2, controller.abort).start()
+    start = time.perf_counter()
+    assert len(controller.read_buffer(100)) == 0
+    assert time.perf_counter() - start < 1.0
+    controller.set_nplc(0.01)
+    assert len(controller.read_buffer(10)) == 10
+
+
+@pytest.mark.parametrize('start, stop', [(0.0, 1.0), (1.0, -1.0)])
+def test_sweep_voltage(controller, start, stop):
+    readings = controller.sweep_voltage(start, stop, 0.1)
+    npoints = int(round(abs(stop - start) / 0.1)) + 1
+    assert len(readings) == npoints
+    assert np.allclose(readings.vsource, np.linspace(start, stop, npoints), atol=1e-6)
+    assert controller.get_setting('source_operate')
+
+
+def test_sweep_voltage_errors(controller):
+    with pytest.raises(ValueError):
+        controller.sweep_voltage(0.0, 1.0, 0.0)
+    with pytest.raises(ValueError):
+        controller.sweep_voltage(0.0, 10.0, 0.001)  # larger than the buffer
+
+
+def test_autoranger():
+    with pytest.raises(ValueError):
+        AutoRanger(upper=0.5, lower=0.05)
+    autoranger = AutoRanger(upper=0.9, lower=0.05)
+    assert autoranger.next_range('2uA', 1.9e-6) == '20uA'
+    assert autoranger.next_range('2uA', 1e-9, STATUS_OVERFLOW) == '20uA'
+    assert autoranger.next_range('2uA', 5e-8) == '200nA'
+    assert autoranger.next_range('2uA', 1e-6) is None
+    assert autoranger.next_range('20mA', 1.0) is None  # already on the largest range
+    assert autoranger.next_range('2nA', 0.0) is None  # already on the smallest range
+    autoranger.remember(1.0, '2uA')
+    assert autoranger.recall(1.0) == '2uA'
+    assert autoranger.recall(2.0) is None
+
+
+def test_adaptive_nplc():
+    scheduler = AdaptiveNPLC(target_snr=100, min_nplc=0.01, max_nplc=10, noise=1e-12)
+    assert scheduler.nplc_for(0.0) == 10
+    assert scheduler.update(1e-6, 10, 1.0) == 0.01  # (100 * 1e-12 / 1e-6) ** 2 = 1e-8 NPLC
+    assert scheduler.nplc_for(1.0) == 0.01
+    assert scheduler.update(1e-11, 0.01, 2.0) == 10
+    assert scheduler.update(2e-10, 10, 3.0) == pytest.approx(0.25)
+    # the same integration split over 5 averaged conversions
+    assert scheduler.update(2e-10, 10, 4.0, count=5) == pytest.approx(0.05)
+    with pytest.raises(ValueError):
+        AdaptiveNPLC(min_nplc=1, max_nplc=0.1)